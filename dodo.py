@@ -1,2 +1,5 @@
 from experiments import *
 from mul_verify_timeout_experiment import *
+import telemetry
+
+DOIT_CONFIG = {"reporter": telemetry.TelemetryReporter}
@@ -0,0 +1,400 @@
+"""Budgeted synthesis-option autotuning with successive halving.
+
+For each benchmark and tool, candidate configurations (e.g. Vivado
+synth_options and synth_design directives) are drawn from a search space in the
+manifest. Every candidate runs the cheapest rung of the flow (e.g. Vivado
+synthesis only); only the best 1/eta of them go on to the next, more expensive
+rung, and so on, so that only a few survivors get full place-and-route. The
+number of initial candidates is the largest the compute budget allows.
+
+All tasks are created up front: each rung has a fixed number of slots, and a
+selection task between rungs decides which candidate each slot runs.
+"""
+
+import itertools
+import json
+import logging
+import math
+import random
+import subprocess
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from doit.tools import config_changed
+
+import telemetry
+import vivado
+import yosys
+
+# Summary fields which are not resource counts.
+_NON_RESOURCE_FIELDS = ["time_s", "watchdog_timeouts", "watchdog_stalls"]
+
+
+def search_space(options: Dict[str, List[Any]]) -> List[Dict[str, Any]]:
+    """All configurations in a search space.
+
+    Args:
+        options: Map from option name (e.g. synth_options) to its values.
+
+    Returns:
+        One dict per combination of option values, in a stable order.
+    """
+    names = sorted(options)
+    return [
+        dict(zip(names, values))
+        for values in itertools.product(*[options[name] for name in names])
+    ]
+
+
+def plan_successive_halving(
+    num_configs: int, budget: float, eta: float, rung_costs: List[float]
+) -> List[int]:
+    """Number of candidates to run at each rung.
+
+    Rung r runs ceil(n / eta^r) candidates, each costing rung_costs[r]. Picks
+    the largest n (at most num_configs) whose total cost fits in the budget.
+
+    Returns:
+        Number of candidates per rung; always at least one per rung.
+    """
+
+    def rung_sizes(n: int) -> List[int]:
+        return [max(1, math.ceil(n / eta**r)) for r in range(len(rung_costs))]
+
+    def cost(n: int) -> float:
+        return sum(size * c for (size, c) in zip(rung_sizes(n), rung_costs))
+
+    n = num_configs
+    while n > 1 and cost(n) > budget:
+        n -= 1
+    if cost(n) > budget:
+        logging.warning(
+            "Autotuning budget %s is too small for even one candidate (costs %s).",
+            budget,
+            cost(n),
+        )
+    return rung_sizes(n)
+
+
+def initial_candidates(
+    space: List[Dict[str, Any]],
+    num_candidates: int,
+    baseline: Dict[str, Any],
+    seed: int,
+) -> List[Tuple[int, Dict[str, Any]]]:
+    """Choose the candidates for the first rung.
+
+    The baseline (the benchmark's hand-set configuration) is always included
+    when it is in the search space, so autotuning never does worse than it.
+    The rest are sampled deterministically from the search space.
+
+    Returns:
+        (candidate id, config) pairs, where the id indexes into space.
+    """
+    ids = list(range(len(space)))
+    chosen = [ids.pop(space.index(baseline))] if baseline in space else []
+    chosen += random.Random(seed).sample(ids, num_candidates - len(chosen))
+    return [(i, space[i]) for i in chosen]
+
+
+def objective(resources: Dict[str, int], weights: Dict[str, float]) -> float:
+    """Weighted resource count; lower is better.
+
+    Args:
+        weights: Weight per cell type. Cell types not listed use the weight
+          under the key "default".
+    """
+    return sum(
+        count * weights.get(cell, weights["default"])
+        for (cell, count) in resources.items()
+    )
+
+
+def run_candidate(
+    tool: str,
+    tool_args: Dict[str, Any],
+    output_dirpath: Union[str, Path],
+    result_filepath: Union[str, Path],
+    objective_weights: Dict[str, float],
+    slot: int,
+    candidate: Optional[Tuple[int, Dict[str, Any]]] = None,
+    selection_filepath: Optional[Union[str, Path]] = None,
+):
+    """DoIt action running one candidate in one rung slot.
+
+    The candidate is either given directly (first rung) or is the slot-th entry
+    of the previous rung's selection. A candidate whose tool run fails is
+    recorded as failed rather than failing the task, so that one bad
+    configuration doesn't stop the search.
+
+    Args:
+        tool: "vivado" or "yosys".
+        tool_args: Arguments for the tool's synthesis function, apart from the
+          candidate's options and output paths.
+    """
+    output_dirpath = Path(output_dirpath)
+    output_dirpath.mkdir(parents=True, exist_ok=True)
+
+    if candidate is None:
+        selection = json.loads(Path(selection_filepath).read_text())
+        if slot >= len(selection):
+            # Fewer candidates survived than there are slots.
+            with open(result_filepath, "w") as f:
+                json.dump({"skipped": True}, f)
+            return
+        candidate = (selection[slot]["candidate"], selection[slot]["config"])
+    (candidate_id, config) = candidate
+
+    summary_filepath = output_dirpath / "summary.json"
+    log_filepath = output_dirpath / "synthesis.log"
+    try:
+        if tool == "vivado":
+            vivado.xilinx_ultrascale_plus_vivado_synthesis(
+                synth_opt_place_route_output_filepath=output_dirpath / "output.sv",
+                tcl_script_filepath=output_dirpath / "synthesis.tcl",
+                log_path=log_filepath,
+                summary_filepath=summary_filepath,
+                synth_options=config["synth_options"] or "",
+                directive=config["directive"],
+                **tool_args,
+            )
+        elif tool == "yosys":
+            tool_args = dict(tool_args)
+            family = tool_args.pop("family")
+            yosys.yosys_synthesis(
+                output_filepath=output_dirpath / "output.sv",
+                log_filepath=log_filepath,
+                summary_filepath=summary_filepath,
+                synth_command=f"synth_xilinx -family {family} {config['synth_options'] or ''}",
+                **tool_args,
+            )
+        else:
+            raise ValueError(f"Unknown tool {tool}")
+    except subprocess.CalledProcessError as e:
+        logging.error(
+            "Autotuning candidate %s failed (%s); see %s", config, e, log_filepath
+        )
+        with open(result_filepath, "w") as f:
+            json.dump({"candidate": candidate_id, "config": config, "failed": True}, f)
+        return
+
+    summary = json.loads(summary_filepath.read_text())
+    resources = {
+        key: value
+        for (key, value) in summary.items()
+        if key not in _NON_RESOURCE_FIELDS
+    }
+    result = {
+        "candidate": candidate_id,
+        "config": config,
+        "failed": False,
+        "objective": objective(resources, objective_weights),
+        "resources": resources,
+        "time_s": summary["time_s"],
+    }
+    if tool == "vivado":
+        result["wns_ns"] = vivado.parse_vivado_wns(log_filepath.read_text())
+    with open(result_filepath, "w") as f:
+        json.dump(result, f)
+
+
+def _ranked_results(result_filepaths: List[Union[str, Path]]) -> List[Dict]:
+    """Successful candidate results, best first."""
+    results = [json.loads(Path(f).read_text()) for f in result_filepaths]
+    results = [r for r in results if not r.get("skipped") and not r["failed"]]
+    return sorted(results, key=lambda r: (r["objective"], r["time_s"]))
+
+
+def select_survivors(
+    result_filepaths: List[Union[str, Path]],
+    num_survivors: int,
+    selection_filepath: Union[str, Path],
+):
+    """DoIt action picking the candidates which go on to the next rung."""
+    survivors = _ranked_results(result_filepaths)[:num_survivors]
+    with open(selection_filepath, "w") as f:
+        json.dump(
+            [{"candidate": r["candidate"], "config": r["config"]} for r in survivors],
+            f,
+        )
+
+
+def write_best(
+    result_filepaths: List[Union[str, Path]],
+    best_filepath: Union[str, Path],
+    extra_fields: Dict[str, Any] = {},
+):
+    """DoIt action writing the best configuration and its results.
+
+    The output is flat, so it can be collected into a CSV with other
+    benchmarks' results.
+    """
+    ranked = _ranked_results(result_filepaths)
+    if not ranked:
+        logging.error("No autotuning candidate succeeded for %s", extra_fields)
+        return False
+    best = ranked[0]
+
+    summary = dict(extra_fields)
+    summary.update(best["config"])
+    summary["candidate"] = best["candidate"]
+    summary["objective"] = best["objective"]
+    summary["time_s"] = best["time_s"]
+    if "wns_ns" in best:
+        summary["wns_ns"] = best["wns_ns"]
+    summary.update(best["resources"])
+    with open(best_filepath, "w") as f:
+        json.dump(summary, f)
+
+
+def make_autotune_tasks(
+    name: str,
+    tool: str,
+    input_filepath: Union[str, Path],
+    output_dirpath: Union[str, Path],
+    space: List[Dict[str, Any]],
+    baseline: Dict[str, Any],
+    rungs: List[Dict[str, Any]],
+    rung_tool_args: List[Dict[str, Any]],
+    budget: float,
+    eta: float,
+    objective_weights: Dict[str, float],
+    seed: int = 0,
+    extra_summary_fields: Dict[str, Any] = {},
+):
+    """Create the successive-halving DoIt tasks for one benchmark and tool.
+
+    Args:
+        name: Prefix for task names.
+        rungs: Rung descriptions from the manifest, cheapest first. Each has a
+          name and a cost, relative to the other rungs.
+        rung_tool_args: Per rung, arguments for the tool's synthesis function
+          (see run_candidate).
+        budget: Total cost, in the units of the rung costs, to spend.
+
+    Returns:
+        (tasks, best_filepath).
+    """
+    output_dirpath = Path(output_dirpath)
+    rung_sizes = plan_successive_halving(
+        len(space), budget, eta, [rung["cost"] for rung in rungs]
+    )
+    candidates = initial_candidates(space, rung_sizes[0], baseline, seed)
+
+    tasks = []
+    selection_filepath = None
+    for r, (rung, size) in enumerate(zip(rungs, rung_sizes)):
+        rung_dirpath = output_dirpath / f"rung_{r}_{rung['name']}"
+        result_filepaths = []
+        tool_args = {
+            **rung_tool_args[r],
+            "module_name": Path(input_filepath).stem,
+            "extra_summary_fields": {},
+            (
+                "instr_src_file" if tool == "vivado" else "input_filepath"
+            ): input_filepath,
+        }
+        for slot in range(size):
+            slot_dirpath = rung_dirpath / f"slot_{slot}"
+            result_filepath = slot_dirpath / "result.json"
+            candidate = candidates[slot] if r == 0 else None
+            task = {
+                "name": f"{name}:rung_{r}:slot_{slot}",
+                "actions": [
+                    (
+                        run_candidate,
+                        [],
+                        {
+                            "tool": tool,
+                            "tool_args": tool_args,
+                            "output_dirpath": slot_dirpath,
+                            "result_filepath": result_filepath,
+                            "objective_weights": objective_weights,
+                            "slot": slot,
+                            "candidate": candidate,
+                            "selection_filepath": selection_filepath,
+                        },
+                    )
+                ],
+                "file_dep": [input_filepath]
+                + ([selection_filepath] if selection_filepath else []),
+                "targets": [result_filepath],
+                # Later rungs' candidates come from selection.json, which is a
+                # file_dep; everything else the result depends on is here.
+                "uptodate": [
+                    config_changed(
+                        {
+                            "tool": tool,
+                            "candidate": candidate,
+                            "tool_args": {
+                                key: str(value) if isinstance(value, Path) else value
+                                for (key, value) in tool_args.items()
+                            },
+                            "objective_weights": objective_weights,
+                        }
+                    )
+                ],
+            }
+            # Only slots run the tool; the select and best tasks are
+            # bookkeeping, so they don't count towards tool throughput.
+            tasks.append(telemetry.instrument(task, tool=tool))
+            result_filepaths.append(result_filepath)
+
+        if r + 1 < len(rungs):
+            selection_filepath = rung_dirpath / "selection.json"
+            tasks.append(
+                {
+                    "name": f"{name}:rung_{r}:select",
+                    "actions": [
+                        (
+                            select_survivors,
+                            [],
+                            {
+                                "result_filepaths": result_filepaths,
+                                "num_survivors": rung_sizes[r + 1],
+                                "selection_filepath": selection_filepath,
+                            },
+                        )
+                    ],
+                    "file_dep": list(result_filepaths),
+                    "targets": [selection_filepath],
+                    "uptodate": [
+                        config_changed(
+                            {
+                                "num_results": len(result_filepaths),
+                                "num_survivors": rung_sizes[r + 1],
+                            }
+                        )
+                    ],
+                }
+            )
+
+    best_filepath = output_dirpath / "best.json"
+    tasks.append(
+        {
+            "name": f"{name}:best",
+            "actions": [
+                (
+                    write_best,
+                    [],
+                    {
+                        "result_filepaths": result_filepaths,
+                        "best_filepath": best_filepath,
+                        "extra_fields": extra_summary_fields,
+                    },
+                )
+            ],
+            "file_dep": list(result_filepaths),
+            "targets": [best_filepath],
+            "uptodate": [
+                config_changed(
+                    {
+                        "num_results": len(result_filepaths),
+                        "extra_fields": extra_summary_fields,
+                    }
+                )
+            ],
+        }
+    )
+
+    return (tasks, best_filepath)
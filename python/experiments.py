@@ -1,10 +1,12 @@
 import json
 import os
 from pathlib import Path
-from typing import List, Union
+from typing import Any, Dict, List, Union
+import autotune
 import util
 import vivado
 import pandas
+import stats
 import yosys
 import numpy as np
 
@@ -21,16 +23,200 @@ def _collect_json_to_csv(
     ).to_csv(output_filepath, index=False)
 
 
+def _benchmark_features(benchmark) -> Dict[str, Any]:
+    """Get the features of a manifest benchmark entry, or {} if it has none."""
+    if "features" in benchmark.keys() and benchmark["features"] is not None:
+        return dict(benchmark["features"])
+    return {}
+
+
+def _watchdog_args(
+    manifest: Dict, tool: str, benchmark: Dict, scale: float = 1.0
+) -> Dict[str, float]:
+    """Watchdog timeout arguments for a synthesis task maker.
+
+    The tool's timeouts are scaled to the benchmark; the timeout for counting
+    resources in the tool's output is not.
+    """
+    (timeout_s, stall_timeout_s) = util.watchdog_timeouts(
+        manifest, tool, _benchmark_features(benchmark), scale=scale
+    )
+    return {
+        "timeout_s": timeout_s,
+        "stall_timeout_s": stall_timeout_s,
+        "stat_timeout_s": manifest["watchdog"]["timeout_s"]["yosys_stat"],
+    }
+
+
+def _lint_gated(task: Dict, benchmark_name: str) -> Dict:
+    """Make a task depend on its benchmark passing lint (see task_lint_benchmarks)."""
+    task.setdefault("task_dep", []).append(f"lint_benchmarks:{benchmark_name}")
+    return task
+
+
+def task_lint_benchmarks():
+    """Preflight: lint every benchmark in one batched Yosys process.
+
+    Checks that each benchmark parses and elaborates with its module name as the
+    top, and that its port widths match its features. Defined first so it runs
+    before anything else; synthesis tasks depend on their benchmark's result, so
+    bad manifest entries are rejected before any tool time is spent on them.
+    """
+    manifest = util.get_manifest()
+
+    entries = []
+    for benchmark in manifest["benchmarks"]:
+        filepath = util.churchroad_evaluation_dir() / benchmark["filepath"]
+        entries.append(
+            {
+                "name": filepath.stem,
+                "filepath": str(filepath),
+                "module_name": filepath.stem,
+                "features": _benchmark_features(benchmark),
+            }
+        )
+
+    (tasks, _) = yosys.make_yosys_lint_tasks(
+        entries=entries,
+        output_dirpath=util.output_dir() / "lint",
+        feature_ports=manifest["lint_feature_ports"],
+        timeout_s=manifest["watchdog"]["timeout_s"]["yosys"],
+        stall_timeout_s=manifest["watchdog"]["stall_timeout_s"]["yosys"],
+    )
+    yield from tasks
+
+
+def _make_quick_tier_task(manifest: Dict, benchmark: Dict):
+    """Make the quick-tier Vivado task for a manifest benchmark entry.
+
+    Returns:
+        (task, json_filepath).
+    """
+    filepath = util.churchroad_evaluation_dir() / benchmark["filepath"]
+    benchmark_name = filepath.stem
+
+    (task, (json_filepath, _, _, _)) = (
+        vivado.make_xilinx_ultrascale_plus_vivado_synthesis_task_noopt(
+            name=f"{benchmark_name}:compile:vivado_quick",
+            input_filepath=filepath,
+            output_dirpath=util.output_dir() / benchmark_name / "vivado_quick",
+            module_name=benchmark_name,
+            synth_options=benchmark.get("synth_options") or "",
+            place_route=manifest["quick_tier_place_route"],
+            attempts=manifest["vivado_num_attempts"],
+            **_watchdog_args(
+                manifest,
+                "vivado",
+                benchmark,
+                scale=manifest["watchdog"]["quick_tier_scale"],
+            ),
+            part_name=manifest["vivado_pynq_part_name"],
+            extra_summary_fields={
+                "tool": "vivado_quick",
+                "name": benchmark_name,
+                **_benchmark_features(benchmark),
+            },
+        )
+    )
+    return (_lint_gated(task, benchmark_name), json_filepath)
+
+
+def task_quick_compile_benchmarks():
+    """Quick tier: a fast Vivado pass over the whole manifest.
+
+    Defined before task_compile_benchmarks so that DoIt schedules all of these
+    first, catching broken designs and producing rough numbers early.
+    """
+    manifest = util.get_manifest()
+    if not manifest.get("quick_tier", False):
+        return
+
+    json_filepaths = []
+    for benchmark in manifest["benchmarks"]:
+        (task, json_filepath) = _make_quick_tier_task(manifest, benchmark)
+        yield task
+        json_filepaths.append(json_filepath)
+
+    output_csv_path = util.output_dir() / manifest["quick_output_csv_filepath"]
+    yield {
+        "name": "collect_data",
+        "targets": [output_csv_path],
+        "actions": [
+            (
+                _collect_json_to_csv,
+                [],
+                {
+                    "filepaths": json_filepaths,
+                    "output_filepath": output_csv_path,
+                },
+            )
+        ],
+        "file_dep": json_filepaths,
+    }
+
+
+def _make_collect_task(
+    iteration: int,
+    identifier: str,
+    architecture: str,
+    tool: str,
+    json_filepath: Union[str, Path],
+):
+    """Make a task which tags a summary JSON with its iteration, tool, etc.
+
+    Returns:
+        (task, collected_data_filepath).
+    """
+    collected_data_filepath = (
+        util.output_dir()
+        / "collected_data"
+        / identifier
+        / tool
+        / f"iteration_{iteration}.json"
+    )
+    task = {
+        "name": f"{identifier}:collect:{tool}:{iteration}",
+        "actions": [
+            (
+                util.collect,
+                [],
+                {
+                    "iteration": iteration,
+                    "identifier": identifier,
+                    "architecture": architecture,
+                    "tool": tool,
+                    "json_filepath": json_filepath,
+                    "collected_data_filepath": collected_data_filepath,
+                },
+            )
+        ],
+        "file_dep": [json_filepath],
+        "targets": [collected_data_filepath],
+    }
+    return (task, collected_data_filepath)
+
+
+def _feature_names(manifest: Dict) -> List[str]:
+    """All feature names used by benchmarks in the manifest."""
+    return sorted(
+        {
+            feature
+            for benchmark in manifest["benchmarks"]
+            for feature in _benchmark_features(benchmark)
+        }
+    )
+
+
 def task_compile_benchmarks():
     manifest = util.get_manifest()
     output_dir = util.output_dir()
 
-    json_filepaths = []
+    collected_data_filepaths = []
 
     for benchmark in manifest["benchmarks"]:
         filepath = util.churchroad_evaluation_dir() / benchmark["filepath"]
         benchmark_name = filepath.stem
-        benchmark_extra_summary_fields = {"tool": "vivado", "name": benchmark_name}
+        benchmark_extra_summary_fields = {"name": benchmark_name}
         benchmark_synth_options = ""
 
         if (
@@ -38,46 +224,247 @@ def task_compile_benchmarks():
             and benchmark["synth_options"] is not None
         ):
             benchmark_synth_options = benchmark["synth_options"]
-        if "features" in benchmark.keys() and benchmark["features"] is not None:
-            benchmark_features = benchmark["features"]
-            for feature in benchmark_features:
-                benchmark_extra_summary_fields[feature] = benchmark_features[feature]
-
-        # Vivado compilation.
-        vivado_output_dirpath = util.output_dir() / benchmark_name / "vivado"
-        (task, (json_filepath, _, _, _)) = (
-            vivado.make_xilinx_ultrascale_plus_vivado_synthesis_task_opt(
-                name=f"{benchmark_name}:compile:vivado",
+        benchmark_extra_summary_fields.update(_benchmark_features(benchmark))
+
+        # Each iteration gets its own outputs, so that we get one timing
+        # sample per iteration.
+        for iteration in range(manifest["iterations"]):
+            iteration_output_dirpath = (
+                output_dir / benchmark_name / f"iteration_{iteration}"
+            )
+
+            # Vivado compilation (full tier).
+            if manifest.get("full_tier", True):
+                (task, (json_filepath, _, _, _)) = (
+                    vivado.make_xilinx_ultrascale_plus_vivado_synthesis_task_opt(
+                        name=f"{benchmark_name}:compile:vivado:{iteration}",
+                        input_filepath=filepath,
+                        output_dirpath=iteration_output_dirpath / "vivado",
+                        module_name=benchmark_name,
+                        synth_options=benchmark_synth_options,
+                        attempts=manifest["vivado_num_attempts"],
+                        part_name=manifest["vivado_pynq_part_name"],
+                        extra_summary_fields=benchmark_extra_summary_fields,
+                        **_watchdog_args(manifest, "vivado", benchmark),
+                    )
+                )
+                # Only schedule the full run once the quick run has passed. This
+                # is a task_dep rather than a file_dep so that rerunning the
+                # quick tier doesn't invalidate the full tier's results.
+                if manifest.get("quick_tier", False):
+                    (quick_task, _) = _make_quick_tier_task(manifest, benchmark)
+                    task.setdefault("task_dep", []).append(
+                        f"quick_compile_benchmarks:{quick_task['name']}"
+                    )
+                yield _lint_gated(task, benchmark_name)
+
+                (task, collected_data_filepath) = _make_collect_task(
+                    iteration=iteration,
+                    identifier=benchmark_name,
+                    architecture=manifest["vivado_pynq_part_name"],
+                    tool="vivado",
+                    json_filepath=json_filepath,
+                )
+                yield task
+                collected_data_filepaths.append(collected_data_filepath)
+
+            # Yosys compilation.
+            (task, (json_filepath, _, _)) = yosys.make_xilinx_yosys_synthesis_task(
+                name=f"{benchmark_name}:compile:yosys:{iteration}",
                 input_filepath=filepath,
-                output_dirpath=vivado_output_dirpath,
+                output_dirpath=iteration_output_dirpath / "yosys",
                 module_name=benchmark_name,
-                synth_options=benchmark_synth_options,
-                attempts=manifest["vivado_num_attempts"],
-                part_name=manifest["vivado_pynq_part_name"],
-                extra_summary_fields=benchmark_extra_summary_fields,
+                family=manifest["yosys_pynq_family"],
+                extra_summary_fields={"name": benchmark_name},
+                attempts=manifest["yosys_num_attempts"],
+                **_watchdog_args(manifest, "yosys", benchmark),
+            )
+            yield _lint_gated(task, benchmark_name)
+
+            (task, collected_data_filepath) = _make_collect_task(
+                iteration=iteration,
+                identifier=benchmark_name,
+                architecture=manifest["yosys_pynq_family"],
+                tool="yosys",
+                json_filepath=json_filepath,
+            )
+            yield task
+            collected_data_filepaths.append(collected_data_filepath)
+
+    output_csv_path = output_dir / manifest["output_csv_filepath"]
+    yield {
+        "name": "collect_data",
+        # To generate the CSV with incomplete data, you can comment out the following line.
+        # "file_dep": collected_data_output_filepaths,
+        "targets": [output_csv_path],
+        "actions": [
+            (
+                _collect_json_to_csv,
+                [],
+                {
+                    "filepaths": collected_data_filepaths,
+                    "output_filepath": output_csv_path,
+                },
+            )
+        ],
+        "file_dep": collected_data_filepaths,
+    }
+
+    summary_csv_path = output_dir / manifest["summary_csv_filepath"]
+    yield {
+        "name": "summarize_iterations",
+        "targets": [summary_csv_path],
+        "actions": [
+            (
+                stats.summarize_results_csv,
+                [],
+                {
+                    "results_csv_filepath": output_csv_path,
+                    "output_filepath": summary_csv_path,
+                    "exclude_columns": _feature_names(manifest),
+                },
+            )
+        ],
+        "file_dep": [output_csv_path],
+    }
+
+
+def task_compare_to_baseline():
+    """Compare this run's results against a baseline run's results CSV.
+
+    Only statistically significant changes are flagged. Pass the baseline with
+    `doit compare_to_baseline --baseline <results.csv>`, the CRE_BASELINE_PATH
+    environment variable, or baseline_csv_filepath in the manifest.
+    """
+    manifest = util.get_manifest()
+    output_dir = util.output_dir()
+    output_csv_path = output_dir / manifest["output_csv_filepath"]
+    comparison_csv_path = output_dir / manifest["comparison_csv_filepath"]
+
+    return {
+        "actions": [
+            (
+                stats.compare_results_csvs,
+                [],
+                {
+                    "results_csv_filepath": output_csv_path,
+                    "output_filepath": comparison_csv_path,
+                    "exclude_columns": _feature_names(manifest),
+                    "min_relative_change": manifest["regression_min_relative_change"],
+                    "min_iterations": manifest["regression_min_iterations"],
+                },
             )
+        ],
+        "params": [
+            {
+                "name": "baseline_csv_filepath",
+                "long": "baseline",
+                "type": str,
+                "default": manifest.get("baseline_csv_filepath") or "",
+                "help": "Results CSV of the baseline run.",
+            }
+        ],
+        "file_dep": [output_csv_path],
+        "uptodate": [False],
+        "verbosity": 2,
+    }
+
+
+def task_compile_target_matrix():
+    """Compile every benchmark for every target in the manifest's target matrix.
+
+    Each benchmark is parsed and elaborated by Yosys once; all Yosys targets
+    then start from the shared RTLIL, so they run in parallel without repeating
+    the front end. Vivado targets read the original source, as Vivado cannot
+    consume RTLIL.
+
+    Disabled unless target_matrix.enabled is set in the manifest (or
+    CRE_TARGET_MATRIX is set).
+    """
+    manifest = util.get_manifest()
+    if not manifest["target_matrix"]["enabled"]:
+        return
+
+    output_dir = util.output_dir()
+    targets = manifest["target_matrix"]["targets"]
+
+    json_filepaths = []
+
+    for benchmark in manifest["benchmarks"]:
+        filepath = util.churchroad_evaluation_dir() / benchmark["filepath"]
+        benchmark_name = filepath.stem
+        benchmark_features = _benchmark_features(benchmark)
+        matrix_output_dirpath = output_dir / benchmark_name / "target_matrix"
+        (elaboration_timeout_s, elaboration_stall_timeout_s) = util.watchdog_timeouts(
+            manifest, "yosys", benchmark_features
         )
-        yield task
-        json_filepaths.append(json_filepath)
 
-        # Yosys compilation.
-        yosys_output_dirpath = util.output_dir() / benchmark_name / "yosys"
-        (task, (json_filepath, _, _)) = yosys.make_xilinx_yosys_synthesis_task(
-            name=f"{benchmark_name}:compile:yosys",
+        (task, (rtlil_filepath, _)) = yosys.make_yosys_elaboration_task(
+            name=f"{benchmark_name}:elaborate",
             input_filepath=filepath,
-            output_dirpath=yosys_output_dirpath,
+            output_dirpath=matrix_output_dirpath / "elaborated",
             module_name=benchmark_name,
-            family=manifest["yosys_pynq_family"],
-            extra_summary_fields={"tool": "yosys", "name": benchmark_name},
+            timeout_s=elaboration_timeout_s,
+            stall_timeout_s=elaboration_stall_timeout_s,
         )
-        yield task
-        json_filepaths.append(json_filepath)
+        yield _lint_gated(task, benchmark_name)
 
-    output_csv_path = output_dir / manifest["output_csv_filepath"]
+        for target in targets:
+            target_name = target["name"]
+            target_output_dirpath = matrix_output_dirpath / target_name
+            extra_summary_fields = {
+                "tool": target["tool"],
+                "name": benchmark_name,
+                "target": target_name,
+                **benchmark_features,
+            }
+
+            if target["tool"] == "yosys" and target["family"] == "ecp5":
+                (task, (json_filepath, _, _)) = (
+                    yosys.make_lattice_ecp5_yosys_synthesis_task(
+                        name=f"{benchmark_name}:compile:{target_name}",
+                        input_filepath=rtlil_filepath,
+                        output_dirpath=target_output_dirpath,
+                        module_name=benchmark_name,
+                        extra_summary_fields=extra_summary_fields,
+                        attempts=manifest["yosys_num_attempts"],
+                        **_watchdog_args(manifest, "yosys", benchmark),
+                    )
+                )
+            elif target["tool"] == "yosys":
+                (task, (json_filepath, _, _)) = yosys.make_xilinx_yosys_synthesis_task(
+                    name=f"{benchmark_name}:compile:{target_name}",
+                    input_filepath=rtlil_filepath,
+                    output_dirpath=target_output_dirpath,
+                    module_name=benchmark_name,
+                    family=target["family"],
+                    extra_summary_fields=extra_summary_fields,
+                    attempts=manifest["yosys_num_attempts"],
+                    **_watchdog_args(manifest, "yosys", benchmark),
+                )
+            elif target["tool"] == "vivado":
+                (task, (json_filepath, _, _, _)) = (
+                    vivado.make_xilinx_ultrascale_plus_vivado_synthesis_task_opt(
+                        name=f"{benchmark_name}:compile:{target_name}",
+                        input_filepath=filepath,
+                        output_dirpath=target_output_dirpath,
+                        module_name=benchmark_name,
+                        synth_options=benchmark.get("synth_options") or "",
+                        attempts=manifest["vivado_num_attempts"],
+                        part_name=target["part_name"],
+                        extra_summary_fields=extra_summary_fields,
+                        **_watchdog_args(manifest, "vivado", benchmark),
+                    )
+                )
+            else:
+                raise ValueError(f"Unknown tool {target['tool']} in target matrix")
+
+            yield _lint_gated(task, benchmark_name)
+            json_filepaths.append(json_filepath)
+
+    output_csv_path = output_dir / manifest["target_matrix_output_csv_filepath"]
     yield {
         "name": "collect_data",
-        # To generate the CSV with incomplete data, you can comment out the following line.
-        # "file_dep": collected_data_output_filepaths,
         "targets": [output_csv_path],
         "actions": [
             (
@@ -91,3 +478,105 @@ def task_compile_benchmarks():
         ],
         "file_dep": json_filepaths,
     }
+
+
+def task_autotune():
+    """Autotune synthesis options per benchmark with successive halving.
+
+    Disabled unless autotune.enabled is set in the manifest (or CRE_AUTOTUNE is
+    set). See autotune.py and the autotune section of the manifest.
+    """
+    manifest = util.get_manifest()
+    config = manifest["autotune"]
+    if not config.get("enabled", False):
+        return
+
+    output_dir = util.output_dir()
+    best_filepaths = []
+
+    for benchmark in manifest["benchmarks"]:
+        filepath = util.churchroad_evaluation_dir() / benchmark["filepath"]
+        benchmark_name = filepath.stem
+        if config["benchmarks"] and benchmark_name not in config["benchmarks"]:
+            continue
+        baseline_synth_options = benchmark.get("synth_options") or ""
+
+        for tool in config["tools"]:
+            tool_config = config[tool]
+            rungs = tool_config["rungs"]
+            if tool == "vivado":
+                baseline = {
+                    "synth_options": baseline_synth_options,
+                    "directive": "default",
+                }
+                rung_tool_args = [
+                    {
+                        "part_name": manifest["vivado_pynq_part_name"],
+                        "opt_design": rung["place_route"],
+                        "place_route": rung["place_route"],
+                        "attempts": manifest["vivado_num_attempts"],
+                        **_watchdog_args(
+                            manifest,
+                            "vivado",
+                            benchmark,
+                            scale=(
+                                1.0
+                                if rung["place_route"]
+                                else manifest["watchdog"]["quick_tier_scale"]
+                            ),
+                        ),
+                    }
+                    for rung in rungs
+                ]
+            elif tool == "yosys":
+                baseline = {"synth_options": ""}
+                rung_tool_args = [
+                    {
+                        "family": manifest["yosys_pynq_family"],
+                        "attempts": manifest["yosys_num_attempts"],
+                        **_watchdog_args(manifest, "yosys", benchmark),
+                    }
+                    for _ in rungs
+                ]
+            else:
+                raise ValueError(f"Unknown tool {tool} in autotune config")
+
+            (tasks, best_filepath) = autotune.make_autotune_tasks(
+                name=f"{benchmark_name}:{tool}",
+                tool=tool,
+                input_filepath=filepath,
+                output_dirpath=output_dir / "autotune" / benchmark_name / tool,
+                space=autotune.search_space(tool_config["search_space"]),
+                baseline=baseline,
+                rungs=rungs,
+                rung_tool_args=rung_tool_args,
+                budget=tool_config["budget"],
+                eta=config["eta"],
+                objective_weights=config["objective_weights"],
+                seed=config["seed"],
+                extra_summary_fields={
+                    "name": benchmark_name,
+                    "tool": tool,
+                    **_benchmark_features(benchmark),
+                },
+            )
+            for task in tasks:
+                yield _lint_gated(task, benchmark_name)
+            best_filepaths.append(best_filepath)
+
+    output_csv_path = output_dir / config["output_csv_filepath"]
+    yield {
+        "name": "collect_data",
+        "targets": [output_csv_path],
+        "actions": [
+            (
+                _collect_json_to_csv,
+                [],
+                {
+                    "filepaths": best_filepaths,
+                    "output_filepath": output_csv_path,
+                },
+            )
+        ],
+        "file_dep": best_filepaths,
+    }
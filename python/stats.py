@@ -0,0 +1,280 @@
+"""Statistics over repeated evaluation iterations.
+
+Tool runtimes are noisy (contention with other jobs, disk, licensing), so we
+run each benchmark several times and report medians with bootstrap confidence
+intervals rather than single samples. Everything here works on long-form
+tables: one row per (group, metric, iteration).
+"""
+
+import logging
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas
+
+# Columns identifying a single benchmark/tool/architecture combination.
+GROUP_COLUMNS = ["identifier", "tool", "architecture"]
+
+# Metrics which vary between iterations of the same configuration.
+NOISY_METRICS = ["time_s"]
+
+# Numeric summary columns which describe the run rather than measure the design.
+NON_METRIC_COLUMNS = ["watchdog_timeouts", "watchdog_stalls"]
+
+
+def metric_columns(df: pandas.DataFrame, exclude: List[str] = []) -> List[str]:
+    """Numeric columns of a results table which are measurements.
+
+    Args:
+        exclude: Additional columns to leave out, e.g. benchmark features.
+    """
+    excluded = (
+        set(GROUP_COLUMNS) | {"iteration"} | set(NON_METRIC_COLUMNS) | set(exclude)
+    )
+    return [
+        column
+        for column in df.select_dtypes(include="number").columns
+        if column not in excluded
+    ]
+
+
+def _to_long(
+    df: pandas.DataFrame, group_columns: List[str], metrics: List[str]
+) -> pandas.DataFrame:
+    """Melt a results table into (group columns, metric, value) rows."""
+    return df.melt(
+        id_vars=group_columns,
+        value_vars=metrics,
+        var_name="metric",
+        value_name="value",
+    ).dropna(subset=["value"])
+
+
+def _padded_samples(
+    long_df: pandas.DataFrame, keys: List[str]
+) -> Tuple[pandas.DataFrame, np.ndarray, np.ndarray]:
+    """Pack each group's samples into a row of a NaN-padded 2D array.
+
+    Returns:
+        (index, samples, counts), where index holds one row of key values per
+        group, samples has shape (groups, max group size), and counts holds the
+        number of real samples in each row.
+    """
+    long_df = long_df.sort_values(keys, kind="stable")
+    group_ids = long_df.groupby(keys, sort=False).ngroup().to_numpy()
+    positions = long_df.groupby(keys, sort=False).cumcount().to_numpy()
+    index = long_df.drop_duplicates(subset=keys)[keys].reset_index(drop=True)
+
+    counts = np.bincount(group_ids, minlength=len(index))
+    samples = np.full((len(index), counts.max(initial=0)), np.nan)
+    samples[group_ids, positions] = long_df["value"].to_numpy(dtype=float)
+    return (index, samples, counts)
+
+
+def _bootstrap_medians(
+    samples: np.ndarray,
+    counts: np.ndarray,
+    num_bootstrap: int,
+    rng: np.random.Generator,
+) -> np.ndarray:
+    """Bootstrap the median of every row of a padded sample array at once.
+
+    Returns:
+        Array of shape (groups, num_bootstrap).
+    """
+    (num_groups, width) = samples.shape
+    # Draw indices uniformly from [0, count) for each group, then discard the
+    # draws beyond each group's own sample size.
+    draws = np.floor(
+        rng.random((num_groups, num_bootstrap, width)) * counts[:, None, None]
+    ).astype(int)
+    resampled = np.take_along_axis(samples[:, None, :], draws, axis=2)
+    padding = np.arange(width)[None, None, :] >= counts[:, None, None]
+    return np.nanmedian(np.where(padding, np.nan, resampled), axis=2)
+
+
+def summarize_iterations(
+    df: pandas.DataFrame,
+    metrics: List[str],
+    group_columns: List[str] = GROUP_COLUMNS,
+    confidence: float = 0.95,
+    num_bootstrap: int = 1000,
+    seed: int = 0,
+) -> pandas.DataFrame:
+    """Summarize repeated iterations of each group.
+
+    Args:
+        df: Results table with one row per iteration.
+        metrics: Columns of df to summarize.
+        confidence: Confidence level of the bootstrap interval on the median.
+
+    Returns:
+        Table with one row per (group, metric) and columns n, median, q1, q3,
+        iqr, ci_low and ci_high.
+    """
+    keys = group_columns + ["metric"]
+    long_df = _to_long(df, group_columns, metrics)
+    grouped = long_df.groupby(keys)["value"]
+
+    summary = pandas.DataFrame(
+        {
+            "n": grouped.count(),
+            "median": grouped.median(),
+            "q1": grouped.quantile(0.25),
+            "q3": grouped.quantile(0.75),
+        }
+    ).reset_index()
+    summary["iqr"] = summary["q3"] - summary["q1"]
+
+    (index, samples, counts) = _padded_samples(long_df, keys)
+    medians = _bootstrap_medians(
+        samples, counts, num_bootstrap, np.random.default_rng(seed)
+    )
+    alpha = (1 - confidence) / 2
+    index["ci_low"] = np.quantile(medians, alpha, axis=1)
+    index["ci_high"] = np.quantile(medians, 1 - alpha, axis=1)
+
+    return summary.merge(index, on=keys, how="left")
+
+
+def compare_to_baseline(
+    current: pandas.DataFrame,
+    baseline: pandas.DataFrame,
+    metrics: List[str],
+    group_columns: List[str] = GROUP_COLUMNS,
+    noisy_metrics: List[str] = NOISY_METRICS,
+    min_relative_change: float = 0.05,
+    min_iterations: int = 3,
+    confidence: float = 0.95,
+    num_bootstrap: int = 1000,
+    seed: int = 0,
+) -> pandas.DataFrame:
+    """Compare a run against a baseline run, flagging significant changes.
+
+    A change in a noisy metric (e.g. time) is significant when both sides have
+    at least min_iterations samples, the bootstrap confidence interval on the
+    difference of medians excludes zero, and the relative change is at least
+    min_relative_change. Other metrics (e.g. resource counts) are deterministic,
+    so any change in their median is significant.
+
+    Returns:
+        Table with one row per (group, metric) present in both runs, with
+        columns baseline_median, current_median, relative_change, ci_low,
+        ci_high, n_baseline, n_current and significant.
+    """
+    keys = group_columns + ["metric"]
+    long_current = _to_long(current, group_columns, metrics)
+    long_baseline = _to_long(baseline, group_columns, metrics)
+
+    # Only compare groups present in both runs.
+    common = (
+        long_current[keys]
+        .drop_duplicates()
+        .merge(long_baseline[keys].drop_duplicates(), on=keys)
+    )
+    long_current = long_current.merge(common, on=keys)
+    long_baseline = long_baseline.merge(common, on=keys)
+
+    rng = np.random.default_rng(seed)
+    (index, current_samples, current_counts) = _padded_samples(long_current, keys)
+    (baseline_index, baseline_samples, baseline_counts) = _padded_samples(
+        long_baseline, keys
+    )
+    assert index.equals(baseline_index)
+
+    differences = _bootstrap_medians(
+        current_samples, current_counts, num_bootstrap, rng
+    ) - _bootstrap_medians(baseline_samples, baseline_counts, num_bootstrap, rng)
+    alpha = (1 - confidence) / 2
+
+    result = index.copy()
+    result["baseline_median"] = np.nanmedian(baseline_samples, axis=1)
+    result["current_median"] = np.nanmedian(current_samples, axis=1)
+    result["n_baseline"] = baseline_counts
+    result["n_current"] = current_counts
+    result["ci_low"] = np.quantile(differences, alpha, axis=1)
+    result["ci_high"] = np.quantile(differences, 1 - alpha, axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result["relative_change"] = (
+            result["current_median"] - result["baseline_median"]
+        ) / np.abs(result["baseline_median"])
+
+    enough_samples = (current_counts >= min_iterations) & (
+        baseline_counts >= min_iterations
+    )
+    interval_excludes_zero = (result["ci_low"] > 0) | (result["ci_high"] < 0)
+    large_enough = ~(np.abs(result["relative_change"]) < min_relative_change)
+
+    result["significant"] = np.where(
+        result["metric"].isin(noisy_metrics),
+        enough_samples & interval_excludes_zero & large_enough,
+        result["current_median"] != result["baseline_median"],
+    )
+
+    return result
+
+
+def summarize_results_csv(
+    results_csv_filepath: str,
+    output_filepath: str,
+    exclude_columns: List[str] = [],
+):
+    """DoIt action summarizing the iterations in a results CSV."""
+    results = pandas.read_csv(results_csv_filepath)
+    summarize_iterations(
+        results, metric_columns(results, exclude=exclude_columns)
+    ).to_csv(output_filepath, index=False)
+
+
+def compare_results_csvs(
+    results_csv_filepath: str,
+    baseline_csv_filepath: Optional[str],
+    output_filepath: str,
+    exclude_columns: List[str] = [],
+    min_relative_change: float = 0.05,
+    min_iterations: int = 3,
+):
+    """DoIt action comparing a results CSV against a baseline results CSV.
+
+    Writes the full comparison to output_filepath and logs each significant
+    change. Does nothing if no baseline is given.
+    """
+    if not baseline_csv_filepath:
+        logging.info("No baseline given; not comparing results.")
+        return
+
+    current = pandas.read_csv(results_csv_filepath)
+    baseline = pandas.read_csv(baseline_csv_filepath)
+    metrics = sorted(
+        set(metric_columns(current, exclude=exclude_columns))
+        | set(metric_columns(baseline, exclude=exclude_columns))
+    )
+
+    # A resource type missing from a summary means none were used, so a cell
+    # type appearing or disappearing between runs is compared as a change
+    # from/to zero.
+    for df in (current, baseline):
+        for metric in metrics:
+            if metric not in NOISY_METRICS:
+                df[metric] = df[metric].fillna(0) if metric in df.columns else 0
+
+    comparison = compare_to_baseline(
+        current,
+        baseline,
+        metrics,
+        min_relative_change=min_relative_change,
+        min_iterations=min_iterations,
+    )
+    comparison.to_csv(output_filepath, index=False)
+
+    for row in comparison[comparison["significant"]].itertuples():
+        logging.warning(
+            "%s (%s, %s): %s changed from %g to %g (%+.1f%%)",
+            row.identifier,
+            row.tool,
+            row.architecture,
+            row.metric,
+            row.baseline_median,
+            row.current_median,
+            100 * row.relative_change,
+        )
@@ -0,0 +1,412 @@
+"""Live telemetry for evaluation runs.
+
+Telemetry comes from two places:
+
+1. TelemetryReporter, a DoIt reporter, runs in the main DoIt process and sees
+   every task start, finish, fail, or skip. It periodically writes a
+   Prometheus-format textfile and a JSON snapshot of the run, optionally serves
+   both over HTTP, and prints a one-line progress summary.
+2. Task actions wrapped with instrument() run in DoIt's worker processes. They
+   record the worker's PID and the number of tool attempts in a small per-task
+   file, which the reporter reads to report per-task RSS and retry counts.
+
+Enable the reporter by setting DOIT_CONFIG["reporter"] in dodo.py.
+"""
+
+import functools
+import json
+import logging
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from threading import Event, Lock, Thread
+from time import time
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import quote
+
+from doit.reporter import ConsoleReporter
+
+import util
+
+# Set in worker processes while an instrumented action runs.
+_current_task_filepath: Optional[Path] = None
+
+# The telemetry directory, as seen by this worker process. Loaded on the first
+# instrumented action, as loading it means parsing the manifest.
+_worker_telemetry_dir: Optional[Path] = None
+
+
+def telemetry_dir() -> Path:
+    """Directory telemetry is written to."""
+    return util.output_dir() / util.get_manifest()["telemetry_dir"]
+
+
+def _task_filepath(dirpath: Path, task_name: str) -> Path:
+    """Per-task file under the telemetry directory dirpath."""
+    return dirpath / "tasks" / f"{quote(task_name, safe='')}.json"
+
+
+def _write_json_atomic(filepath: Path, data: Any):
+    """Write JSON such that readers never see a partially-written file."""
+    filepath.parent.mkdir(parents=True, exist_ok=True)
+    tmp_filepath = filepath.with_name(f".{filepath.name}.{os.getpid()}.tmp")
+    with open(tmp_filepath, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_filepath, filepath)
+
+
+def _instrumented(action: Callable) -> Callable:
+    """Wrap a task action so that it records its worker PID and attempts.
+
+    The wrapper takes the action's name, so DoIt's messages about the action
+    (e.g. when it returns False) name the action rather than the wrapper.
+    """
+
+    @functools.wraps(action)
+    def run_instrumented(*args, task, **kwargs):
+        global _current_task_filepath, _worker_telemetry_dir
+        if _worker_telemetry_dir is None:
+            _worker_telemetry_dir = telemetry_dir()
+        _current_task_filepath = _task_filepath(_worker_telemetry_dir, task.name)
+        _write_json_atomic(
+            _current_task_filepath,
+            {"pid": os.getpid(), "start_time": time(), "attempts": 1},
+        )
+        try:
+            return action(*args, **kwargs)
+        finally:
+            _current_task_filepath = None
+
+    # DoIt passes `task` only to actions whose signature asks for it, and
+    # inspect.signature would otherwise report the action's own signature.
+    del run_instrumented.__wrapped__
+    return run_instrumented
+
+
+def instrument(task: Dict, tool: str) -> Dict:
+    """Wrap a DoIt task's Python actions so that they feed telemetry.
+
+    Args:
+        task: DoIt task dictionary, modified in place.
+        tool: Tool the task runs, used to report per-tool throughput.
+
+    Returns:
+        The task.
+    """
+    task["actions"] = [
+        (
+            (_instrumented(action[0]), *action[1:])
+            if isinstance(action, tuple)
+            else action
+        )
+        for action in task["actions"]
+    ]
+    task.setdefault("meta", {})["tool"] = tool
+    return task
+
+
+def record_retry():
+    """Record that the current task is retrying its tool.
+
+    Call this from task actions; does nothing outside an instrumented action.
+    """
+    if _current_task_filepath is None:
+        return
+    try:
+        data = json.loads(_current_task_filepath.read_text())
+        data["attempts"] += 1
+        _write_json_atomic(_current_task_filepath, data)
+    except (OSError, ValueError, KeyError) as e:
+        logging.warning("Could not record retry in telemetry: %s", e)
+
+
+def _process_tree_rss_bytes(root_pid: int) -> int:
+    """Total resident set size of a process and all of its descendants."""
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    total = 0
+    for pid in util.process_tree_pids(root_pid):
+        try:
+            total += int(Path(f"/proc/{pid}/statm").read_text().split()[1]) * page_size
+        except (OSError, ValueError, IndexError):
+            continue
+    return total
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_prometheus(snapshot: Dict) -> str:
+    """Format a snapshot in the Prometheus text exposition format."""
+    prefix = "churchroad_evaluation"
+    lines = [
+        f"# HELP {prefix}_tasks Number of tasks in each state.",
+        f"# TYPE {prefix}_tasks gauge",
+    ]
+    for state, count in snapshot["counts"].items():
+        lines.append(f'{prefix}_tasks{{state="{state}"}} {count}')
+
+    lines += [
+        f"# HELP {prefix}_completion_rate_per_minute Tasks finished per minute.",
+        f"# TYPE {prefix}_completion_rate_per_minute gauge",
+        f"{prefix}_completion_rate_per_minute {snapshot['completion_rate_per_minute']}",
+        f"# HELP {prefix}_tool_throughput_per_minute Tasks finished per minute, per tool.",
+        f"# TYPE {prefix}_tool_throughput_per_minute gauge",
+    ]
+    for tool, rate in snapshot["tool_throughput_per_minute"].items():
+        lines.append(
+            f'{prefix}_tool_throughput_per_minute{{tool="{_escape_label(tool)}"}} {rate}'
+        )
+
+    for metric, key, help_text in [
+        ("task_elapsed_seconds", "elapsed_s", "Time the task has been running."),
+        ("task_rss_bytes", "rss_bytes", "RSS of the task and its subprocesses."),
+        ("task_attempts", "attempts", "Number of tool attempts so far."),
+    ]:
+        lines += [
+            f"# HELP {prefix}_{metric} {help_text}",
+            f"# TYPE {prefix}_{metric} gauge",
+        ]
+        for task in snapshot["running"]:
+            if task.get(key) is None:
+                continue
+            labels = (
+                f'task="{_escape_label(task["name"])}",'
+                f'tool="{_escape_label(task["tool"])}"'
+            )
+            lines.append(f"{prefix}_{metric}{{{labels}}} {task[key]}")
+
+    lines += [
+        f"# HELP {prefix}_load1 One-minute load average.",
+        f"# TYPE {prefix}_load1 gauge",
+        f"{prefix}_load1 {snapshot['load_average'][0]}",
+    ]
+    return "\n".join(lines) + "\n"
+
+
+class TelemetryReporter(ConsoleReporter):
+    """Console reporter which also exports run telemetry.
+
+    Every telemetry_interval_s seconds (from the manifest; 0 disables periodic
+    output), writes metrics.prom and snapshot.json to the telemetry directory
+    and prints a progress line. If the manifest's telemetry_port is set, also
+    serves /metrics and /snapshot.json on that port.
+    """
+
+    desc = "console output plus run telemetry"
+
+    def __init__(self, outstream, options):
+        super().__init__(outstream, options)
+        manifest = util.get_manifest()
+        self._interval_s = float(manifest["telemetry_interval_s"])
+        self._port = manifest["telemetry_port"]
+        self._dir = telemetry_dir()
+        self._lock = Lock()
+        self._stop = Event()
+        self._start_time = time()
+        self._queued = set()
+        self._running: Dict[str, Dict] = {}
+        self._finished: List[Dict] = []
+        self._thread: Optional[Thread] = None
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    @staticmethod
+    def _tool(task) -> str:
+        return (task.meta or {}).get("tool", "none")
+
+    def initialize(self, tasks, selected_tasks):
+        super().initialize(tasks, selected_tasks)
+        # Tasks which will be processed: the selected tasks and, transitively,
+        # their dependencies.
+        to_visit = list(selected_tasks)
+        selected = set()
+        while to_visit:
+            name = to_visit.pop()
+            if name in selected or name not in tasks:
+                continue
+            selected.add(name)
+            to_visit.extend(tasks[name].task_dep)
+            to_visit.extend(tasks[name].setup_tasks)
+        with self._lock:
+            self._queued = {name for name in selected if tasks[name].actions}
+
+        if self._interval_s > 0:
+            self._thread = Thread(target=self._export_periodically, daemon=True)
+            self._thread.start()
+        if self._port is not None:
+            self._serve(int(self._port))
+
+    def execute_task(self, task):
+        super().execute_task(task)
+        # Group tasks have no actions and aren't interesting.
+        if not task.actions:
+            return
+        with self._lock:
+            self._queued.discard(task.name)
+            self._running[task.name] = {"tool": self._tool(task), "start": time()}
+
+    def _finish(self, task, state: str):
+        if not task.actions:
+            return
+        with self._lock:
+            self._queued.discard(task.name)
+            running = self._running.pop(task.name, None)
+            self._finished.append(
+                {
+                    "name": task.name,
+                    "tool": self._tool(task),
+                    "state": state,
+                    "elapsed_s": time() - running["start"] if running else None,
+                    "attempts": (
+                        self._read_task_file(task.name).get("attempts")
+                        if running
+                        else None
+                    ),
+                    "end": time(),
+                }
+            )
+
+    def add_success(self, task):
+        super().add_success(task)
+        self._finish(task, "done")
+
+    def add_failure(self, task, fail):
+        super().add_failure(task, fail)
+        self._finish(task, "failed")
+
+    def skip_uptodate(self, task):
+        super().skip_uptodate(task)
+        self._finish(task, "uptodate")
+
+    def skip_ignore(self, task):
+        super().skip_ignore(task)
+        self._finish(task, "ignored")
+
+    def complete_run(self):
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+        self._export()
+        super().complete_run()
+
+    def _read_task_file(self, task_name: str) -> Dict:
+        try:
+            return json.loads(_task_filepath(self._dir, task_name).read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def snapshot(self) -> Dict:
+        """Current state of the run."""
+        now = time()
+        with self._lock:
+            queued = len(self._queued)
+            running = dict(self._running)
+            finished = list(self._finished)
+
+        running_tasks = []
+        for name, info in running.items():
+            task_file = self._read_task_file(name)
+            rss_bytes = None
+            if "pid" in task_file:
+                rss_bytes = _process_tree_rss_bytes(task_file["pid"])
+            running_tasks.append(
+                {
+                    "name": name,
+                    "tool": info["tool"],
+                    "elapsed_s": now - info["start"],
+                    "rss_bytes": rss_bytes,
+                    "attempts": task_file.get("attempts"),
+                }
+            )
+
+        counts = {"queued": queued, "running": len(running)}
+        for state in ["done", "failed", "uptodate", "ignored"]:
+            counts[state] = sum(1 for task in finished if task["state"] == state)
+
+        # Rates only count tasks which actually ran.
+        run_minutes = max(now - self._start_time, 1e-9) / 60
+        executed = [task for task in finished if task["state"] in ("done", "failed")]
+        tool_throughput = {}
+        for task in executed:
+            tool_throughput[task["tool"]] = tool_throughput.get(task["tool"], 0) + 1
+
+        return {
+            "time": now,
+            "run_elapsed_s": now - self._start_time,
+            "counts": counts,
+            "completion_rate_per_minute": len(executed) / run_minutes,
+            "tool_throughput_per_minute": {
+                tool: count / run_minutes for tool, count in tool_throughput.items()
+            },
+            "load_average": list(os.getloadavg()),
+            "running": sorted(running_tasks, key=lambda task: -task["elapsed_s"]),
+            "failed": [task for task in finished if task["state"] == "failed"],
+        }
+
+    def _export(self):
+        try:
+            snapshot = self.snapshot()
+            self._dir.mkdir(parents=True, exist_ok=True)
+            _write_json_atomic(self._dir / "snapshot.json", snapshot)
+            metrics_filepath = self._dir / "metrics.prom"
+            tmp_filepath = self._dir / ".metrics.prom.tmp"
+            tmp_filepath.write_text(_format_prometheus(snapshot))
+            os.replace(tmp_filepath, metrics_filepath)
+        except Exception as e:
+            # Telemetry must never take down the run.
+            logging.warning("Could not export telemetry: %s", e)
+            return
+
+        counts = snapshot["counts"]
+        longest = snapshot["running"][0] if snapshot["running"] else None
+        self.write(
+            f"[telemetry] {counts['running']} running, {counts['queued']} queued,"
+            f" {counts['done']} done, {counts['failed']} failed,"
+            f" {counts['uptodate']} up-to-date;"
+            f" {snapshot['completion_rate_per_minute']:.2f} tasks/min;"
+            f" load {snapshot['load_average'][0]:.2f}"
+            + (
+                f"; longest: {longest['name']} ({longest['elapsed_s']:.0f}s)"
+                if longest
+                else ""
+            )
+            + "\n"
+        )
+
+    def _export_periodically(self):
+        while not self._stop.wait(self._interval_s):
+            self._export()
+
+    def _serve(self, port: int):
+        reporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body = _format_prometheus(reporter.snapshot())
+                    content_type = "text/plain; version=0.0.4"
+                elif self.path == "/snapshot.json":
+                    body = json.dumps(reporter.snapshot())
+                    content_type = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.end_headers()
+                self.wfile.write(body.encode())
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self._server = ThreadingHTTPServer(("", port), Handler)
+        except OSError as e:
+            # Telemetry must never take down the run.
+            logging.warning(
+                "Could not serve telemetry on port %d (%s); continuing without it.",
+                port,
+                e,
+            )
+            return
+        Thread(target=self._server.serve_forever, daemon=True).start()
@@ -5,9 +5,12 @@ import logging
 import os
 from pathlib import Path
 import re
+import select
+import signal
 import subprocess
-from tempfile import NamedTemporaryFile
-from typing import Dict, Union
+from tempfile import NamedTemporaryFile, TemporaryFile
+from time import time
+from typing import Dict, IO, List, Optional, Tuple, Union
 import yaml
 
 
@@ -37,28 +40,253 @@ def _parse_yosys_log(log_txt: str):
     return resources
 
 
+def process_tree_pids(root_pid: int) -> List[int]:
+    """PIDs of a process and all of its (living) descendants, via /proc."""
+    children: Dict[int, List[int]] = {}
+    for entry in os.scandir("/proc"):
+        if not entry.name.isdigit():
+            continue
+        try:
+            stat = Path(entry.path, "stat").read_text()
+        except OSError:
+            continue
+        # The command name may contain spaces, so split after its closing paren.
+        ppid = int(stat[stat.rindex(")") + 2 :].split()[1])
+        children.setdefault(ppid, []).append(int(entry.name))
+
+    pids = []
+    pending = [root_pid]
+    while pending:
+        pid = pending.pop()
+        pids.append(pid)
+        pending.extend(children.get(pid, []))
+    return pids
+
+
+def _process_tree_cpu_s(root_pid: int) -> float:
+    """Total user+system CPU time of a process tree, in seconds."""
+    ticks = 0
+    for pid in process_tree_pids(root_pid):
+        try:
+            stat = Path(f"/proc/{pid}/stat").read_text()
+        except OSError:
+            continue
+        fields = stat[stat.rindex(")") + 2 :].split()
+        # utime and stime are fields 14 and 15 of /proc/<pid>/stat.
+        ticks += int(fields[11]) + int(fields[12])
+    return ticks / os.sysconf("SC_CLK_TCK")
+
+
+def _open_pidfd(pid: int) -> Optional[int]:
+    """A pidfd for pid, or None if the process is gone or pidfds are unsupported.
+
+    A pidfd refers to one process for as long as it is open, so signals sent
+    through it can never reach an unrelated process which reused the PID."""
+    try:
+        return os.pidfd_open(pid)
+    except OSError:
+        return None
+
+
+def _kill_process_tree(process: subprocess.Popen, grace_period_s: float = 10):
+    """Kill a process started with start_new_session=True and all descendants.
+
+    Descendants which left the process group are found via /proc, so they are
+    killed too. Descendants can outlive the root (e.g. a wrapper script which
+    exits on SIGTERM while the real tool ignores it), so anything in the tree
+    which is still running after the grace period gets SIGKILL, even if the root
+    has already exited."""
+    descendants = [
+        (pid, _open_pidfd(pid))
+        for pid in process_tree_pids(process.pid)
+        if pid != process.pid
+    ]
+    deadline = time() + grace_period_s
+    try:
+        for sig in [signal.SIGTERM, signal.SIGKILL]:
+            try:
+                os.killpg(process.pid, sig)
+            except ProcessLookupError:
+                pass
+            process.send_signal(sig)
+            for pid, pidfd in descendants:
+                try:
+                    if pidfd is not None:
+                        signal.pidfd_send_signal(pidfd, sig)
+                    else:
+                        os.kill(pid, sig)
+                except ProcessLookupError:
+                    pass
+
+            if sig == signal.SIGTERM:
+                try:
+                    process.wait(timeout=grace_period_s)
+                except subprocess.TimeoutExpired:
+                    pass
+                # A pidfd becomes readable when its process exits.
+                for _, pidfd in descendants:
+                    if pidfd is not None:
+                        select.select([pidfd], [], [], max(0.0, deadline - time()))
+        process.wait()
+    finally:
+        for _, pidfd in descendants:
+            if pidfd is not None:
+                os.close(pidfd)
+
+
+WATCHDOG_TIMEOUT = "timeout"
+WATCHDOG_STALL = "stall"
+
+
+def run_with_watchdog(
+    args: List[str],
+    stdout: IO,
+    stderr: IO,
+    timeout_s: Optional[float] = None,
+    stall_timeout_s: Optional[float] = None,
+    log_filepath: Optional[Union[str, Path]] = None,
+    stall_min_cpu_s: float = 1.0,
+    poll_interval_s: float = 5.0,
+    env: Optional[Dict[str, str]] = None,
+) -> Tuple[subprocess.CompletedProcess, Optional[str]]:
+    """Run a tool subprocess, killing it if it times out or stalls.
+
+    The process is considered stalled when, for stall_timeout_s seconds, its log
+    file has not grown and its process tree has used less than stall_min_cpu_s
+    of CPU time. When the process times out or stalls, its whole process tree is
+    killed; the returned CompletedProcess then has a nonzero return code, so
+    callers can treat it like any other failed run.
+
+    Args:
+        log_filepath: File to watch for progress. Defaults to stdout's file, if
+          it has a path.
+
+    Returns:
+        (completed_process, event), where event is WATCHDOG_TIMEOUT,
+        WATCHDOG_STALL, or None if the process exited on its own.
+    """
+    if log_filepath is None and isinstance(
+        getattr(stdout, "name", None), (str, os.PathLike)
+    ):
+        log_filepath = stdout.name
+
+    process = subprocess.Popen(
+        args, stdout=stdout, stderr=stderr, env=env, start_new_session=True
+    )
+    start_time = time()
+    progress_time = start_time
+    progress_log_size = -1
+    progress_cpu_s = 0.0
+    event = None
+
+    try:
+        while True:
+            try:
+                process.wait(timeout=min(poll_interval_s, timeout_s or poll_interval_s))
+                break
+            except subprocess.TimeoutExpired:
+                pass
+            now = time()
+
+            if timeout_s is not None and now - start_time > timeout_s:
+                event = WATCHDOG_TIMEOUT
+            elif stall_timeout_s is not None:
+                log_size = (
+                    Path(log_filepath).stat().st_size
+                    if log_filepath is not None and Path(log_filepath).exists()
+                    else 0
+                )
+                cpu_s = _process_tree_cpu_s(process.pid)
+                if (
+                    log_size > progress_log_size
+                    or cpu_s - progress_cpu_s >= stall_min_cpu_s
+                ):
+                    (progress_time, progress_log_size, progress_cpu_s) = (
+                        now,
+                        log_size,
+                        cpu_s,
+                    )
+                elif now - progress_time > stall_timeout_s:
+                    event = WATCHDOG_STALL
+
+            if event is not None and process.poll() is None:
+                logging.error(
+                    "Watchdog: %s (pid %d) %s after %.0fs; killing its process tree.",
+                    args[0],
+                    process.pid,
+                    "timed out" if event == WATCHDOG_TIMEOUT else "stalled",
+                    now - start_time,
+                )
+                _kill_process_tree(process)
+                break
+            event = None
+    except BaseException:
+        # Don't leak the tool if watching it fails (or we are interrupted).
+        if process.poll() is None:
+            _kill_process_tree(process)
+        raise
+
+    return (subprocess.CompletedProcess(args, process.wait()), event)
+
+
 def count_resources_in_verilog_src(
-    verilog_src: str, module_name: str
+    verilog_src: str, module_name: str, timeout_s: Optional[float] = None
 ) -> Dict[str, int]:
-    with NamedTemporaryFile(mode="w") as f:
+    """Count the cells in a Verilog module using Yosys's stat command.
+
+    Args:
+        timeout_s: Watchdog timeout for Yosys. None means no timeout.
+    """
+    with NamedTemporaryFile(mode="w") as f, TemporaryFile(mode="w+") as out:
         with f.file as file_object:
             file_object.write(verilog_src)
 
-        out = subprocess.run(
-            [
-                "yosys",
-                "-p",
-                f"read_verilog {f.name}; hierarchy -top {module_name}; stat",
-            ],
-            capture_output=True,
-            text=True,
-            check=True,
-        ).stdout
+        args = [
+            "yosys",
+            "-p",
+            f"read_verilog {f.name}; hierarchy -top {module_name}; stat",
+        ]
+        (completed_process, event) = run_with_watchdog(
+            args, stdout=out, stderr=out, timeout_s=timeout_s
+        )
+        out.seek(0)
+        out = out.read()
+        if completed_process.returncode != 0:
+            raise subprocess.CalledProcessError(
+                completed_process.returncode,
+                args,
+                output=out + (f"\nKilled by watchdog: {event}" if event else ""),
+            )
 
     # print(out)
     return _parse_yosys_log(out)
 
 
+def watchdog_timeouts(
+    manifest: Dict, tool: str, features: Dict[str, int], scale: float = 1.0
+) -> Tuple[float, float]:
+    """Watchdog hard timeout and stall timeout for a tool run on a benchmark.
+
+    The tool's base timeout is scaled by the benchmark's expected cost: its
+    total port bitwidth (the sum of its *_bw* features) relative to the
+    manifest's watchdog reference_bitwidth, and never less than 1. It is also
+    multiplied by scale, e.g. to shorten the timeout for quick runs. The
+    tool's stall timeout is not scaled.
+
+    Returns:
+        (timeout_s, stall_timeout_s).
+    """
+    watchdog = manifest["watchdog"]
+    total_bitwidth = sum(
+        value for (feature, value) in features.items() if "_bw" in feature
+    )
+    size_scale = max(1.0, total_bitwidth / watchdog["reference_bitwidth"])
+    return (
+        watchdog["timeout_s"][tool] * size_scale * scale,
+        watchdog["stall_timeout_s"][tool],
+    )
+
+
 def collect(
     iteration: int,
     identifier: str,
@@ -93,6 +321,18 @@ def collect(
 CRE_OUTPUT_DIR_ENV_VAR = "CRE_OUTPUT_DIR"
 CRE_MANIFEST_PATH_ENV_VAR = "CRE_MANIFEST_PATH"
 CRE_ITERATIONS_ENV_VAR = "CRE_ITERATIONS"
+CRE_QUICK_TIER_ENV_VAR = "CRE_QUICK_TIER"
+CRE_FULL_TIER_ENV_VAR = "CRE_FULL_TIER"
+CRE_BASELINE_PATH_ENV_VAR = "CRE_BASELINE_PATH"
+CRE_AUTOTUNE_ENV_VAR = "CRE_AUTOTUNE"
+CRE_TARGET_MATRIX_ENV_VAR = "CRE_TARGET_MATRIX"
+CRE_TELEMETRY_INTERVAL_ENV_VAR = "CRE_TELEMETRY_INTERVAL"
+CRE_TELEMETRY_PORT_ENV_VAR = "CRE_TELEMETRY_PORT"
+
+
+def _env_flag(name: str) -> bool:
+    """Interpret environment variable `name` as a boolean flag."""
+    return os.environ[name].strip().lower() in ("1", "true", "yes", "on")
 
 
 def churchroad_evaluation_dir() -> Path:
@@ -155,5 +395,21 @@ def get_manifest() -> Dict:
     # lines like `manifest["key"] = os.environ["KEY"]` to add an override.
     if CRE_ITERATIONS_ENV_VAR in os.environ:
         manifest["iterations"] = int(os.environ[CRE_ITERATIONS_ENV_VAR])
+    if CRE_QUICK_TIER_ENV_VAR in os.environ:
+        manifest["quick_tier"] = _env_flag(CRE_QUICK_TIER_ENV_VAR)
+    if CRE_FULL_TIER_ENV_VAR in os.environ:
+        manifest["full_tier"] = _env_flag(CRE_FULL_TIER_ENV_VAR)
+    if CRE_BASELINE_PATH_ENV_VAR in os.environ:
+        manifest["baseline_csv_filepath"] = os.environ[CRE_BASELINE_PATH_ENV_VAR]
+    if CRE_AUTOTUNE_ENV_VAR in os.environ:
+        manifest["autotune"]["enabled"] = _env_flag(CRE_AUTOTUNE_ENV_VAR)
+    if CRE_TARGET_MATRIX_ENV_VAR in os.environ:
+        manifest["target_matrix"]["enabled"] = _env_flag(CRE_TARGET_MATRIX_ENV_VAR)
+    if CRE_TELEMETRY_INTERVAL_ENV_VAR in os.environ:
+        manifest["telemetry_interval_s"] = float(
+            os.environ[CRE_TELEMETRY_INTERVAL_ENV_VAR]
+        )
+    if CRE_TELEMETRY_PORT_ENV_VAR in os.environ:
+        manifest["telemetry_port"] = int(os.environ[CRE_TELEMETRY_PORT_ENV_VAR])
 
     return manifest
@@ -2,14 +2,35 @@
 
 import json
 import logging
+import math
 import os
-import subprocess
+import re
 import sys
 from dataclasses import dataclass
 from pathlib import Path
 from time import time
 from typing import Any, Dict, Optional, Tuple, Union
+from doit.tools import config_changed
 from util import count_resources_in_verilog_src
+import telemetry
+import util
+
+
+def parse_vivado_wns(log_txt: str) -> Optional[float]:
+    """Worst negative slack, in ns, from a Vivado report_timing_summary log.
+
+    Returns None if the log has no timing summary or no slack was computed
+    (e.g. the design has no clock constraints)."""
+    match = re.search(
+        r"^\s*WNS\(ns\).*\n\s*-+.*\n\s*(?P<wns>\S+)", log_txt, flags=re.MULTILINE
+    )
+    if match is None:
+        return None
+    try:
+        wns = float(match["wns"])
+    except ValueError:
+        return None
+    return wns if math.isfinite(wns) else None
 
 
 def xilinx_ultrascale_plus_vivado_synthesis(
@@ -25,12 +46,16 @@ def xilinx_ultrascale_plus_vivado_synthesis(
     synth_design: bool = True,
     opt_design: bool = True,
     synth_design_rtl_flags: bool = False,
+    place_route: bool = True,
     clock_info: Optional[Tuple[str, float, Tuple[float, float]]] = None,
     place_directive: str = "default",
     route_directive: str = "default",
     extra_summary_fields: Dict[str, Any] = {},
     max_threads: int = 1,
     attempts: int = 1,
+    timeout_s: Optional[float] = None,
+    stall_timeout_s: Optional[float] = None,
+    stat_timeout_s: Optional[float] = None,
 ):
     """Synthesize with Xilinx Vivado.
 
@@ -46,6 +71,9 @@ def xilinx_ultrascale_plus_vivado_synthesis(
         opt_design: Whether or not to run Vivado's opt_design command.
         synth_design_rtl_flags: Whether or not to pass the -rtl and all
           -rtl_skip_* flags to synth_design.
+        place_route: Whether or not to run Vivado's place_design and
+          route_design commands. When False, the synthesized netlist is
+          written out instead.
         summary_filepath: Output JSON summary filepath.
         clock_info: Clock name and period in nanoseconds. When provided, a
           constraint file will be created and loaded using the given clock
@@ -54,6 +82,12 @@ def xilinx_ultrascale_plus_vivado_synthesis(
         attempts: Number of times to attempt running Vivado synthesis, in the
           case where Vivado fails (which occurs ~once per evaluation run).
         part_name: The part name to use for synthesis.
+        timeout_s: Watchdog timeout for a single Vivado attempt. A Vivado which
+          runs longer is killed and counts as a failed attempt.
+        stall_timeout_s: Watchdog stall timeout. A Vivado whose log stops
+          growing and whose CPU usage stays flat for this long is killed and
+          counts as a failed attempt.
+        stat_timeout_s: Watchdog timeout for counting resources in the output.
     """
     log_path = Path(log_path)
     log_path.parent.mkdir(parents=True, exist_ok=True)
@@ -103,13 +137,13 @@ set_property top ${{modname}} [current_fileset]
 {synth_design_command if synth_design else f"# {synth_design_command}"}
 read_xdc -mode out_of_context {xdc_filepath}
 {"opt_design" if opt_design else "# opt_design"}
-place_design -directive {place_directive}
+{"" if place_route else "# "}place_design -directive {place_directive}
 # route_design causes problems when run inside the Docker container. Originally,
 # I used -release_memory, because I thought the issue was memory related. This
 # fixed the issue, but only because (as I later discovered) -release_memory
 # doesn't actually run routing! So we need to see if the crash still occurs, 
 # and if it does, we need another way around it.
-route_design -directive {route_directive}
+{"" if place_route else "# "}route_design -directive {route_directive}
 write_verilog -force ${{synth_opt_place_route_output_filepath}}
 report_timing_summary
 report_utilization
@@ -131,7 +165,7 @@ report_utilization
             )
 
             start_time = time()
-            completed_process = subprocess.run(
+            completed_process, watchdog_event = util.run_with_watchdog(
                 [
                     "vivado",
                     # -stack 2000 is a way to sometimes prevent mysterious Vivado
@@ -143,35 +177,52 @@ report_utilization
                     "-source",
                     tcl_script_filepath,
                 ],
-                check=False,
                 stdout=logfile,
                 stderr=logfile,
+                timeout_s=timeout_s,
+                stall_timeout_s=stall_timeout_s,
                 env=env,
             )
             end_time = time()
-        return (completed_process, end_time - start_time)
+        return (completed_process, end_time - start_time, watchdog_event)
 
-    completed_process, elapsed_time = _run_vivado()
+    # Watchdog events (timeouts and stalls) over all attempts.
+    watchdog_events = []
+
+    completed_process, elapsed_time, watchdog_event = _run_vivado()
+    watchdog_events.append(watchdog_event)
     attempts_remaining = attempts - 1
-    # If Vivado failed, try again.
+    # If Vivado failed (including being killed by the watchdog), try again.
     while completed_process.returncode != 0 and attempts_remaining > 0:
         logging.error(
-            "Vivado synthesis failed with return code %d. Attempts remaining: %d. Trying again...",
+            "Vivado synthesis failed with return code %d%s. Attempts remaining: %d. Trying again...",
             completed_process.returncode,
+            f" (watchdog: {watchdog_event})" if watchdog_event else "",
             attempts_remaining,
         )
-        completed_process, elapsed_time = _run_vivado()
+        telemetry.record_retry()
+        completed_process, elapsed_time, watchdog_event = _run_vivado()
+        watchdog_events.append(watchdog_event)
         attempts_remaining = attempts_remaining - 1
 
+    if completed_process.returncode != 0 and watchdog_event:
+        logging.error(
+            "Vivado killed by watchdog (%s) on final attempt. Log: %s",
+            watchdog_event,
+            log_path,
+        )
     completed_process.check_returncode()
 
     summary = count_resources_in_verilog_src(
         verilog_src=synth_opt_place_route_output_filepath.read_text(),
         module_name=module_name,
+        timeout_s=stat_timeout_s,
     )
 
     assert "time_s" not in summary
     summary["time_s"] = elapsed_time
+    summary["watchdog_timeouts"] = watchdog_events.count(util.WATCHDOG_TIMEOUT)
+    summary["watchdog_stalls"] = watchdog_events.count(util.WATCHDOG_STALL)
 
     for key in extra_summary_fields:
         assert key not in summary
@@ -195,6 +246,9 @@ def make_xilinx_ultrascale_plus_vivado_synthesis_task_opt(
     fail_if_constraints_not_met: Optional[bool] = None,
     extra_summary_fields: Dict[str, Any] = {},
     attempts: Optional[int] = None,
+    timeout_s: Optional[float] = None,
+    stall_timeout_s: Optional[float] = None,
+    stat_timeout_s: Optional[float] = None,
 ):
     """Wrapper over Vivado synthesis function which creates a DoIt task.
 
@@ -240,6 +294,12 @@ def make_xilinx_ultrascale_plus_vivado_synthesis_task_opt(
         synth_args["attempts"] = attempts
     if synth_options is not None:
         synth_args["synth_options"] = synth_options
+    if timeout_s is not None:
+        synth_args["timeout_s"] = timeout_s
+    if stall_timeout_s is not None:
+        synth_args["stall_timeout_s"] = stall_timeout_s
+    if stat_timeout_s is not None:
+        synth_args["stat_timeout_s"] = stat_timeout_s
 
     task = {
         "actions": [
@@ -257,7 +317,7 @@ def make_xilinx_ultrascale_plus_vivado_synthesis_task_opt(
         task["name"] = name
 
     return (
-        task,
+        telemetry.instrument(task, tool="vivado"),
         (
             output_filepaths["summary_filepath"],
             output_filepaths["synth_opt_place_route_output_filepath"],
@@ -271,58 +331,101 @@ def make_xilinx_ultrascale_plus_vivado_synthesis_task_noopt(
     input_filepath: Union[str, Path],
     output_dirpath: Union[str, Path],
     module_name: str,
-    synth_options: str = None,
+    part_name: str,
+    synth_options: str = "",
     clock_info: Optional[Tuple[str, float]] = None,
+    name: Optional[str] = None,
+    place_route: bool = True,
+    extra_summary_fields: Dict[str, Any] = {},
     attempts: Optional[int] = None,
+    timeout_s: Optional[float] = None,
+    stall_timeout_s: Optional[float] = None,
+    stat_timeout_s: Optional[float] = None,
 ):
     """Wrapper over Vivado synthesis function which creates a DoIt task.
 
     This task will run Vivado without optimizations, optimized for making
-    synthesis fast."""
+    synthesis fast. All directives are RuntimeOptimized, and opt_design is
+    skipped. If place_route is False, only synthesis is run.
+
+    Returns:
+        (task, (json_filepath, verilog_filepath, log_filepath, tcl_filepath)).
+    """
 
     input_filepath = Path(input_filepath)
     output_dirpath = Path(output_dirpath)
-    synth_opt_place_route_output_filepath = output_dirpath / input_filepath.name
-    time_filepath = output_dirpath / f"{input_filepath.stem}.time"
-    log_filepath = output_dirpath / f"{input_filepath.stem}.log"
-    tcl_script_filepath = output_dirpath / f"{input_filepath.stem}.tcl"
-    json_filepath = output_dirpath / f"{input_filepath.stem}.json"
 
-    synth_opts = {
+    output_filepaths = {
+        "synth_opt_place_route_output_filepath": output_dirpath / input_filepath.name,
+        "log_filepath": output_dirpath / f"{input_filepath.stem}.log",
+        "tcl_script_filepath": output_dirpath / f"{input_filepath.stem}.tcl",
+        "summary_filepath": output_dirpath / f"{input_filepath.stem}_summary.json",
+    }
+
+    synth_args = {
         "instr_src_file": input_filepath,
-        "synth_opt_place_route_output_filepath": synth_opt_place_route_output_filepath,
+        "synth_opt_place_route_output_filepath": output_filepaths[
+            "synth_opt_place_route_output_filepath"
+        ],
         "module_name": module_name,
-        "time_filepath": time_filepath,
-        "log_path": log_filepath,
-        "tcl_script_filepath": tcl_script_filepath,
+        "log_path": output_filepaths["log_filepath"],
+        "tcl_script_filepath": output_filepaths["tcl_script_filepath"],
         "directive": "RuntimeOptimized",
         "place_directive": "RuntimeOptimized",
         "route_directive": "RuntimeOptimized",
-        "synth_options": synth_options,
+        "synth_options": synth_options if synth_options is not None else "",
         "opt_design": False,
         "synth_design": True,
         "synth_design_rtl_flags": False,
+        "place_route": place_route,
         "clock_info": clock_info,
-        "json_filepath": json_filepath,
+        "summary_filepath": output_filepaths["summary_filepath"],
+        "extra_summary_fields": extra_summary_fields,
+        "part_name": part_name,
     }
 
     if attempts is not None:
-        synth_opts["attempts"] = attempts
+        synth_args["attempts"] = attempts
+    if timeout_s is not None:
+        synth_args["timeout_s"] = timeout_s
+    if stall_timeout_s is not None:
+        synth_args["stall_timeout_s"] = stall_timeout_s
+    if stat_timeout_s is not None:
+        synth_args["stat_timeout_s"] = stat_timeout_s
 
-    return {
+    task = {
         "actions": [
             (
                 xilinx_ultrascale_plus_vivado_synthesis,
                 [],
-                synth_opts,
+                synth_args,
             )
         ],
         "file_dep": [input_filepath],
-        "targets": [
-            synth_opt_place_route_output_filepath,
-            time_filepath,
-            log_filepath,
-            tcl_script_filepath,
-            json_filepath,
+        "targets": list(output_filepaths.values()),
+        # Rerun if the flow changes (e.g. place_route is toggled), even though
+        # the input file has not.
+        "uptodate": [
+            config_changed(
+                {
+                    "part_name": part_name,
+                    "synth_options": synth_args["synth_options"],
+                    "place_route": place_route,
+                    "clock_info": clock_info,
+                }
+            )
         ],
     }
+
+    if name is not None:
+        task["name"] = name
+
+    return (
+        telemetry.instrument(task, tool="vivado"),
+        (
+            output_filepaths["summary_filepath"],
+            output_filepaths["synth_opt_place_route_output_filepath"],
+            output_filepaths["log_filepath"],
+            output_filepaths["tcl_script_filepath"],
+        ),
+    )
@@ -1,12 +1,99 @@
 import json
 import logging
 from pathlib import Path
+import re
 import subprocess
 import sys
 from time import time
-from typing import Any, Dict, Optional, Tuple, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 from util import count_resources_in_verilog_src
+import telemetry
+import util
+from doit.exceptions import TaskFailed
+from doit.tools import config_changed
+
+
+def _yosys_read_command(input_filepath: Union[str, Path]) -> str:
+    """Yosys command for reading the given file.
+
+    RTLIL files (.il), such as those produced by yosys_elaborate, are read with
+    read_rtlil. Everything else is assumed to be (System)Verilog source."""
+    if Path(input_filepath).suffix == ".il":
+        return f"read_rtlil {input_filepath}"
+    return f"read -sv {input_filepath}"
+
+
+def _run_yosys(
+    script: str,
+    log_filepath: Path,
+    timeout_s: Optional[float] = None,
+    stall_timeout_s: Optional[float] = None,
+) -> Tuple[subprocess.CompletedProcess, Optional[str]]:
+    """Run a Yosys script under the watchdog, logging to log_filepath.
+
+    Returns:
+        (completed_process, watchdog_event), as util.run_with_watchdog.
+    """
+    with open(log_filepath, "w") as logfile:
+        return util.run_with_watchdog(
+            ["yosys", "-d", "-p", script],
+            stdout=logfile,
+            stderr=logfile,
+            timeout_s=timeout_s,
+            stall_timeout_s=stall_timeout_s,
+        )
+
+
+def yosys_elaborate(
+    input_filepath: Union[str, Path],
+    module_name: str,
+    output_filepath: Union[str, Path],
+    log_filepath: Union[str, Path],
+    timeout_s: Optional[float] = None,
+    stall_timeout_s: Optional[float] = None,
+):
+    """Parse and elaborate a design once, writing the result as RTLIL.
+
+    Runs the target-independent front half of synthesis (read, hierarchy, proc,
+    early opt) so that multiple per-target synthesis runs can start from the
+    same intermediate rather than each re-reading and re-elaborating the RTL.
+    """
+    output_filepath = Path(output_filepath)
+    log_filepath = Path(log_filepath)
+    output_filepath.parent.mkdir(parents=True, exist_ok=True)
+    log_filepath.parent.mkdir(parents=True, exist_ok=True)
+
+    logging.info("Running Yosys elaboration on %s", input_filepath)
+    completed_process, watchdog_event = _run_yosys(
+        f"""
+        read -sv {input_filepath}
+        hierarchy -check -top {module_name}
+        proc
+        opt_clean
+        write_rtlil {output_filepath}""",
+        log_filepath,
+        timeout_s=timeout_s,
+        stall_timeout_s=stall_timeout_s,
+    )
+    if completed_process.returncode != 0:
+        print(
+            f"Error log in {log_filepath}"
+            + (f" (killed by watchdog: {watchdog_event})" if watchdog_event else ""),
+            file=sys.stderr,
+        )
+        completed_process.check_returncode()
+
+
+def _is_transient_failure(returncode: int, watchdog_event: Optional[str]) -> bool:
+    """Whether a failed Yosys run is worth retrying.
+
+    True if the watchdog killed Yosys or Yosys died from a signal (a negative
+    return code, or 128 + the signal number if it ran under a shell). Yosys
+    exits with 1 on errors in the design or script, which would just happen
+    again.
+    """
+    return watchdog_event is not None or returncode < 0 or returncode > 128
 
 
 def yosys_synthesis(
@@ -17,41 +104,80 @@ def yosys_synthesis(
     log_filepath: Union[str, Path],
     summary_filepath: Union[str, Path],
     extra_summary_fields: Dict[str, Any] = {},
+    attempts: int = 1,
+    timeout_s: Optional[float] = None,
+    stall_timeout_s: Optional[float] = None,
+    stat_timeout_s: Optional[float] = None,
 ):
+    """Synthesize with Yosys.
+
+    Args:
+        attempts: Number of times to attempt running Yosys, in the case where
+          it crashes or is killed by the watchdog. Ordinary Yosys errors are
+          deterministic, so they are not retried.
+        timeout_s: Watchdog timeout for a single Yosys attempt.
+        stall_timeout_s: Watchdog stall timeout for a single Yosys attempt.
+        stat_timeout_s: Watchdog timeout for counting resources in the output.
+    """
     output_filepath.parent.mkdir(parents=True, exist_ok=True)
     log_filepath.parent.mkdir(parents=True, exist_ok=True)
 
-    # Synthesis with Yosys.
-    with open(log_filepath, "w") as logfile:
+    def _run_synthesis():
+        # Synthesis with Yosys.
         logging.info("Running Yosys synthesis on %s", input_filepath)
-        try:
-            yosys_start_time = time()
-            subprocess.run(
-                [
-                    "yosys",
-                    "-d",
-                    "-p",
-                    f"""
-                    read -sv {input_filepath}
-                    hierarchy -top {module_name}
-                    {synth_command}
-                    stat
-                    write_verilog {output_filepath}""",
-                ],
-                check=True,
-                stdout=logfile,
-                stderr=logfile,
-            )
-            yosys_end_time = time()
-        except subprocess.CalledProcessError as e:
-            print(f"Error log in {(str(logfile.name))}", file=sys.stderr)
-            raise e
+        yosys_start_time = time()
+        completed_process, watchdog_event = _run_yosys(
+            f"""
+            {_yosys_read_command(input_filepath)}
+            hierarchy -top {module_name}
+            {synth_command}
+            stat
+            write_verilog {output_filepath}""",
+            log_filepath,
+            timeout_s=timeout_s,
+            stall_timeout_s=stall_timeout_s,
+        )
+        yosys_end_time = time()
+        return (completed_process, yosys_end_time - yosys_start_time, watchdog_event)
+
+    # Watchdog events (timeouts and stalls) over all attempts.
+    watchdog_events = []
+
+    completed_process, elapsed_time, watchdog_event = _run_synthesis()
+    watchdog_events.append(watchdog_event)
+    attempts_remaining = attempts - 1
+    while (
+        _is_transient_failure(completed_process.returncode, watchdog_event)
+        and attempts_remaining > 0
+    ):
+        logging.error(
+            "Yosys synthesis failed with return code %d%s. Attempts remaining: %d. Trying again...",
+            completed_process.returncode,
+            f" (watchdog: {watchdog_event})" if watchdog_event else "",
+            attempts_remaining,
+        )
+        telemetry.record_retry()
+        completed_process, elapsed_time, watchdog_event = _run_synthesis()
+        watchdog_events.append(watchdog_event)
+        attempts_remaining = attempts_remaining - 1
+
+    if completed_process.returncode != 0:
+        print(
+            f"Error log in {log_filepath}"
+            + (f" (killed by watchdog: {watchdog_event})" if watchdog_event else ""),
+            file=sys.stderr,
+        )
+        completed_process.check_returncode()
 
     # Generate summary
-    summary = count_resources_in_verilog_src(output_filepath.read_text(), module_name)
+    summary = count_resources_in_verilog_src(
+        output_filepath.read_text(), module_name, timeout_s=stat_timeout_s
+    )
 
     assert "time_s" not in summary
-    summary["time_s"] = yosys_end_time - yosys_start_time
+    summary["time_s"] = elapsed_time
+    summary["watchdog_timeouts"] = watchdog_events.count(util.WATCHDOG_TIMEOUT)
+    summary["watchdog_stalls"] = watchdog_events.count(util.WATCHDOG_STALL)
 
     for key in extra_summary_fields:
         assert key not in summary
@@ -61,6 +187,279 @@ def yosys_synthesis(
         json.dump(summary, f)
 
 
+def _lint_ports(
+    design_json: Dict, entry: Dict, feature_ports: Dict[str, str]
+) -> List[str]:
+    """Check a linted design's ports against its manifest features.
+
+    Returns:
+        List of error messages; empty if the ports match.
+    """
+    module = design_json["modules"].get(entry["module_name"])
+    if module is None:
+        return [f"Module {entry['module_name']} not found after elaboration"]
+
+    errors = []
+    for feature, width in entry["features"].items():
+        if feature not in feature_ports:
+            continue
+        port_name = feature_ports[feature]
+        port = module["ports"].get(port_name)
+        if port is None:
+            errors.append(
+                f"Feature {feature} refers to port {port_name}, which "
+                f"{entry['module_name']} does not have"
+            )
+        elif len(port["bits"]) != width:
+            errors.append(
+                f"Feature {feature} is {width} but port {port_name} is "
+                f"{len(port['bits'])} bits wide"
+            )
+    return errors
+
+
+def lint_benchmarks(
+    entries: List[Dict],
+    output_dirpath: Union[str, Path],
+    log_filepath: Union[str, Path],
+    feature_ports: Dict[str, str],
+    timeout_s: Optional[float] = None,
+    stall_timeout_s: Optional[float] = None,
+):
+    """Lint many benchmarks in a single batched Yosys process.
+
+    Each benchmark is read, elaborated with `hierarchy -check -top` and `proc`, and its
+    ports are checked against the widths given in its features. Yosys stops at
+    the first error, so when a benchmark fails, it is marked as failed and
+    Yosys is restarted on the remaining benchmarks.
+
+    Writes one result JSON per benchmark, {"name", "filepath", "ok", "errors"},
+    to output_dirpath/<name>.json.
+
+    Args:
+        entries: Dicts with keys name, filepath, module_name and features.
+        feature_ports: Map from feature name (e.g. a_bw_i) to the name of the
+          port whose width it gives (e.g. a).
+    """
+    output_dirpath = Path(output_dirpath)
+    log_filepath = Path(log_filepath)
+    output_dirpath.mkdir(parents=True, exist_ok=True)
+    log_filepath.parent.mkdir(parents=True, exist_ok=True)
+
+    errors = {entry["name"]: [] for entry in entries}
+    for entry in entries:
+        if not Path(entry["filepath"]).exists():
+            errors[entry["name"]].append(f"File {entry['filepath']} does not exist")
+
+    remaining = [entry for entry in entries if not errors[entry["name"]]]
+    log_txt = ""
+    while remaining:
+        script_filepath = output_dirpath / "lint.ys"
+        script_filepath.write_text(
+            "\n".join(
+                f"""design -reset
+log CRE_LINT_BEGIN {i}
+read -sv {entry['filepath']}
+hierarchy -check -top {entry['module_name']}
+proc
+write_json {output_dirpath / f"{entry['name']}.design.json"}
+log CRE_LINT_END {i}"""
+                for (i, entry) in enumerate(remaining)
+            )
+        )
+
+        batch_log_filepath = output_dirpath / "lint_batch.log"
+        with open(batch_log_filepath, "w") as logfile:
+            completed_process, watchdog_event = util.run_with_watchdog(
+                ["yosys", "-s", str(script_filepath)],
+                stdout=logfile,
+                stderr=logfile,
+                timeout_s=timeout_s,
+                stall_timeout_s=stall_timeout_s,
+            )
+        batch_log_txt = batch_log_filepath.read_text()
+        log_txt += batch_log_txt
+
+        finished = {
+            int(i) for i in re.findall(r"^CRE_LINT_END (\d+)$", batch_log_txt, re.M)
+        }
+        for i in sorted(finished):
+            entry = remaining[i]
+            design_filepath = output_dirpath / f"{entry['name']}.design.json"
+            errors[entry["name"]] += _lint_ports(
+                json.loads(design_filepath.read_text()), entry, feature_ports
+            )
+            design_filepath.unlink()
+
+        if completed_process.returncode == 0:
+            break
+
+        # The first unfinished benchmark is the one Yosys failed on. If a
+        # benchmark was started, blame it; otherwise Yosys failed before reading
+        # anything, so give up on the whole batch.
+        started = {
+            int(i) for i in re.findall(r"^CRE_LINT_BEGIN (\d+)$", batch_log_txt, re.M)
+        }
+        failed = sorted(started - finished)
+        if not failed:
+            raise RuntimeError(f"Yosys lint failed; see {batch_log_filepath}")
+        failed_entry = remaining[failed[0]]
+        failed_start = re.search(
+            rf"^CRE_LINT_BEGIN {failed[0]}$", batch_log_txt, re.M
+        ).start()
+        error_lines = [
+            line
+            for line in batch_log_txt[failed_start:].splitlines()
+            if "ERROR:" in line
+        ]
+        errors[failed_entry["name"]] += error_lines or [
+            (
+                f"Yosys failed (watchdog: {watchdog_event})"
+                if watchdog_event
+                else f"Yosys failed with return code {completed_process.returncode}"
+            )
+        ]
+        remaining = remaining[failed[0] + 1 :]
+
+    log_filepath.write_text(log_txt)
+
+    for entry in entries:
+        with open(output_dirpath / f"{entry['name']}.json", "w") as f:
+            json.dump(
+                {
+                    "name": entry["name"],
+                    "filepath": str(entry["filepath"]),
+                    "ok": not errors[entry["name"]],
+                    "errors": errors[entry["name"]],
+                },
+                f,
+            )
+
+
+def check_lint_result(result_filepath: Union[str, Path]):
+    """DoIt action which fails if a benchmark's lint result has errors."""
+    result = json.loads(Path(result_filepath).read_text())
+    if not result["ok"]:
+        return TaskFailed(
+            f"{result['name']} failed lint:\n  " + "\n  ".join(result["errors"])
+        )
+
+
+def make_yosys_lint_tasks(
+    entries: List[Dict],
+    output_dirpath: Union[str, Path],
+    feature_ports: Dict[str, str],
+    timeout_s: Optional[float] = None,
+    stall_timeout_s: Optional[float] = None,
+):
+    """Create DoIt tasks which lint benchmarks before any synthesis.
+
+    One task lints every benchmark in a single batched Yosys process (see
+    lint_benchmarks). Then, one task per benchmark, named after the benchmark,
+    fails if that benchmark's lint failed. Synthesis tasks should task_dep on
+    the per-benchmark task so that bad entries are rejected early.
+
+    Returns:
+        (tasks, {name: result_filepath}).
+    """
+    output_dirpath = Path(output_dirpath)
+    result_filepaths = {
+        entry["name"]: output_dirpath / f"{entry['name']}.json" for entry in entries
+    }
+    log_filepath = output_dirpath / "lint.log"
+
+    tasks = [
+        {
+            "name": "run",
+            "actions": [
+                (
+                    lint_benchmarks,
+                    [],
+                    {
+                        "entries": entries,
+                        "output_dirpath": output_dirpath,
+                        "log_filepath": log_filepath,
+                        "feature_ports": feature_ports,
+                        "timeout_s": timeout_s,
+                        "stall_timeout_s": stall_timeout_s,
+                    },
+                )
+            ],
+            "file_dep": [
+                entry["filepath"]
+                for entry in entries
+                if Path(entry["filepath"]).exists()
+            ],
+            "targets": list(result_filepaths.values()) + [log_filepath],
+            # Rerun if module names or features change in the manifest.
+            "uptodate": [config_changed({"entries": entries, "ports": feature_ports})],
+        }
+    ]
+    telemetry.instrument(tasks[0], tool="yosys")
+    # The per-benchmark checks only read the lint results; they don't run Yosys,
+    # so they aren't counted as Yosys tasks.
+    tasks += [
+        {
+            "name": name,
+            "actions": [(check_lint_result, [], {"result_filepath": result_filepath})],
+            "file_dep": [result_filepath],
+        }
+        for (name, result_filepath) in result_filepaths.items()
+    ]
+
+    return (tasks, result_filepaths)
+
+
+def make_yosys_elaboration_task(
+    input_filepath: Union[str, Path],
+    output_dirpath: Union[str, Path],
+    module_name: str,
+    name: Optional[str] = None,
+    timeout_s: Optional[float] = None,
+    stall_timeout_s: Optional[float] = None,
+):
+    """Wrapper over Yosys elaboration function which creates a DoIt task.
+
+    The resulting RTLIL file can be passed as the input_filepath of the Yosys
+    synthesis tasks below.
+
+    Returns:
+        (task, (rtlil_filepath, log_filepath)).
+    """
+    output_dirpath = Path(output_dirpath)
+    output_filepaths = {
+        "rtlil_filepath": output_dirpath / f"{module_name}.il",
+        "log_filepath": output_dirpath / f"{module_name}.log",
+    }
+
+    task = {
+        "actions": [
+            (
+                yosys_elaborate,
+                [],
+                {
+                    "input_filepath": input_filepath,
+                    "module_name": module_name,
+                    "output_filepath": output_filepaths["rtlil_filepath"],
+                    "log_filepath": output_filepaths["log_filepath"],
+                    "timeout_s": timeout_s,
+                    "stall_timeout_s": stall_timeout_s,
+                },
+            )
+        ],
+        "file_dep": [input_filepath],
+        "targets": list(output_filepaths.values()),
+    }
+
+    if name is not None:
+        task["name"] = name
+
+    return (
+        telemetry.instrument(task, tool="yosys"),
+        (output_filepaths["rtlil_filepath"], output_filepaths["log_filepath"]),
+    )
+
+
 def make_lattice_ecp5_yosys_synthesis_task(
     input_filepath: Union[str, Path],
     output_dirpath: Union[str, Path],
@@ -68,6 +467,10 @@ def make_lattice_ecp5_yosys_synthesis_task(
     clock_info: Optional[Tuple[str, float]] = None,
     name: Optional[str] = None,
     extra_summary_fields: Dict[str, Any] = {},
+    attempts: Optional[int] = None,
+    timeout_s: Optional[float] = None,
+    stall_timeout_s: Optional[float] = None,
+    stat_timeout_s: Optional[float] = None,
 ):
     """Wrapper over Yosys synthesis function which creates a DoIt task."""
     # TODO(@gussmith23): Support clocks on Lattice.
@@ -92,6 +495,9 @@ def make_lattice_ecp5_yosys_synthesis_task(
                     "synth_command": "synth_ecp5",
                     "log_filepath": log_filepath,
                     "extra_summary_fields": extra_summary_fields,
+                    "timeout_s": timeout_s,
+                    "stall_timeout_s": stall_timeout_s,
+                    "stat_timeout_s": stat_timeout_s,
                 },
             )
         ],
@@ -105,8 +511,13 @@ def make_lattice_ecp5_yosys_synthesis_task(
 
     if name is not None:
         task["name"] = name
+    if attempts is not None:
+        task["actions"][0][2]["attempts"] = attempts
 
-    return (task, (json_filepath, output_filepath, log_filepath))
+    return (
+        telemetry.instrument(task, tool="yosys"),
+        (json_filepath, output_filepath, log_filepath),
+    )
 
 
 def make_xilinx_yosys_synthesis_task(
@@ -117,6 +528,10 @@ def make_xilinx_yosys_synthesis_task(
     clock_info: Optional[Tuple[str, float]] = None,
     name: Optional[str] = None,
     extra_summary_fields: Dict[str, Any] = {},
+    attempts: Optional[int] = None,
+    timeout_s: Optional[float] = None,
+    stall_timeout_s: Optional[float] = None,
+    stat_timeout_s: Optional[float] = None,
 ):
     """Wrapper over Yosys synthesis function which creates a DoIt task."""
     # TODO(@gussmith23): Support clocks on Lattice.
@@ -143,6 +558,9 @@ def make_xilinx_yosys_synthesis_task(
                     "synth_command": f"synth_xilinx -family {family}",
                     "log_filepath": output_filepaths["log_filepath"],
                     "extra_summary_fields": extra_summary_fields,
+                    "timeout_s": timeout_s,
+                    "stall_timeout_s": stall_timeout_s,
+                    "stat_timeout_s": stat_timeout_s,
                 },
             )
         ],
@@ -152,9 +570,11 @@ def make_xilinx_yosys_synthesis_task(
 
     if name is not None:
         task["name"] = name
+    if attempts is not None:
+        task["actions"][0][2]["attempts"] = attempts
 
     return (
-        task,
+        telemetry.instrument(task, tool="yosys"),
         (
             output_filepaths["json_filepath"],
             output_filepaths["output_filepath"],
@@ -2,23 +2,22 @@
 # Runs the evaluation.
 #
 # Environment variables:
-# - PRINT_UPTIME_INTERVAL: If set to a positive number, prints uptime every
-#   PRINT_UPTIME_INTERVAL seconds.
+# - TELEMETRY_INTERVAL: If set to a positive number, writes run telemetry (see
+#   python/telemetry.py) and prints a progress line every TELEMETRY_INTERVAL
+#   seconds. Defaults to the manifest's telemetry_interval_s.
+# - TELEMETRY_PORT: If set, serves run telemetry over HTTP on this port.
 # - NUM_DOIT_TASKS: Number of parallel tasks to run. Defaults to the number of
 #   processors on the machine.
 
 set -eo pipefail
 
-PRINT_UPTIME_INTERVAL="${PRINT_UPTIME_INTERVAL:-0}"
 NUM_DOIT_TASKS="${NUM_DOIT_TASKS:-$(nproc)}"
 
-# Optionally track uptime. Set PRINT_UPTIME_INTERVAL to a positive number to
-# enable.
-if [[ -n "$PRINT_UPTIME_INTERVAL" ]] && [[ $PRINT_UPTIME_INTERVAL -gt 0 ]]; then
-  # Trap to kill uptime process on exit.
-  trap 'kill $(jobs -p)' EXIT
-  # Uptime process.
-  while true; do uptime; sleep $PRINT_UPTIME_INTERVAL; done &
+if [[ -n "$TELEMETRY_INTERVAL" ]]; then
+  export CRE_TELEMETRY_INTERVAL="$TELEMETRY_INTERVAL"
+fi
+if [[ -n "$TELEMETRY_PORT" ]]; then
+  export CRE_TELEMETRY_PORT="$TELEMETRY_PORT"
 fi
 
 echo "Running tasks with ${NUM_DOIT_TASKS} parallel jobs."